@@ -67,6 +67,11 @@ class Constants:
     # The endkey is inclusive, by default.
     CEILING = "ZZZZZZZZ"
 
+    # Maximum number of changes processed in one call of the orders sync API.
+    SYNC_LIMIT = 500
+    # Maximum number of operations in one call of the orders bulk API.
+    BULK_LIMIT = 500
+
     # Entity document types.
     DOCTYPE = "orderportal_doctype"
     ACCOUNT = "account"
@@ -216,6 +221,13 @@ class Constants:
         UNDEFINED,
     )
 
+    # Statuses of outbound email messages in the queue.
+    ### QUEUED = "queued" Already defined above.
+    SENDING = "sending"
+    SENT = "sent"
+    FAILED = "failed"
+    MESSAGE_STATUSES = (QUEUED, SENDING, SENT, FAILED)
+
     # Recipients of order messages.
     OWNER = "owner"
     ORDER_MESSAGE_RECIPIENTS = (ADMIN, STAFF, OWNER, GROUP)
@@ -296,6 +308,24 @@ class Constants:
     XLSX_MIMETYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
     XLSM_MIMETYPE = "application/vnd.ms-excel.sheet.macroEnabled.12"
 
+    # Content types worth compressing when served; others are already compact.
+    COMPRESSIBLE_MIMETYPES = frozenset(
+        [
+            HTML_MIMETYPE,
+            JSON_MIMETYPE,
+            CSV_MIMETYPE,
+            TEXT_MIMETYPE,
+            "text/css",
+            "text/javascript",
+            "application/javascript",
+            "image/svg+xml",
+            "image/x-icon",
+            "image/vnd.microsoft.icon",
+        ]
+    )
+    # Max age (seconds) of cached static and site files having versioned URLs.
+    STATIC_MAX_AGE = 365 * 24 * 60 * 60
+
     # Hard-wired mapping content type -> extension (overriding mimetypes module).
     MIMETYPE_EXTENSIONS = {
         TEXT_MIMETYPE: ".txt",
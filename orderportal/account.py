@@ -5,13 +5,15 @@ import hashlib
 import tornado.web
 
 import orderportal
+import orderportal.database
 from orderportal import constants, settings
+from orderportal import directory
 from orderportal import saver
 from orderportal import utils
 from orderportal.order import OrderApiV1Mixin
 from orderportal.group import GroupSaver
 from orderportal.message import MessageSaver
-from orderportal.requesthandler import RequestHandler
+from orderportal.requesthandler import RequestHandler, ApiV1Mixin
 
 
 def hashed_password(password):
@@ -68,6 +70,10 @@ class AccountSaver(saver.Saver):
             if not self["invoice_ref"]:
                 raise ValueError("Invoice reference is required.")
 
+    def post_process(self):
+        "Update the account directory of this process."
+        directory.update_account(self.doc)
+
 
 class AccessMixin:
     "Mixin for access check methods."
@@ -122,14 +128,24 @@ class RecipientsMixin:
 
 
 class Accounts(RequestHandler):
-    "List of all accounts."
+    """List of all accounts. Filtered, sorted and paginated using
+    the composite index 'account/listing'; only the accounts in the
+    requested page are fetched.
+    """
+
+    # Sort keys in the 'account/listing' view, with default descending order.
+    SORTS = dict(modified=True, email=False, login=True)
 
     @tornado.web.authenticated
     def get(self):
         self.check_staff()
         self.set_filter()
+        self.set_paging(limit=settings["DISPLAY_DEFAULT_PAGE_SIZE"])
         self.render(
-            "account/list.html", accounts=self.get_accounts(), filter=self.filter
+            "account/list.html",
+            accounts=self.get_accounts(),
+            filter=self.filter,
+            paging=self.paging,
         )
 
     def set_filter(self):
@@ -144,28 +160,57 @@ class Accounts(RequestHandler):
             except (tornado.web.MissingArgumentError, KeyError):
                 pass
 
+    def set_paging(self, limit=None):
+        """Set the sort and pagination parameters dictionary.
+        The default sort is by login when showing logins during the last year,
+        since this is a key range in the index. Otherwise by modified.
+        The default limit None means all accounts.
+        """
+        self.paging = dict()
+        sort = self.get_argument("sort", None)
+        if sort not in self.SORTS:
+            if self.filter.get("login", "last year") == "last year":
+                sort = "login"
+            else:
+                sort = "modified"
+        self.paging["sort"] = sort
+        order = self.get_argument("order", None)
+        if order not in ("asc", "desc"):
+            order = self.SORTS[sort] and "desc" or "asc"
+        self.paging["order"] = order
+        try:
+            self.paging["offset"] = max(0, int(self.get_argument("offset", 0)))
+        except ValueError:
+            self.paging["offset"] = 0
+        try:
+            self.paging["limit"] = max(1, int(self.get_argument("limit")))
+        except (tornado.web.MissingArgumentError, ValueError):
+            self.paging["limit"] = limit
+        self.paging["total"] = None
+
     def get_accounts(self):
-        "Get the accounts depending on the filter parameters."
-        accounts = self.filter_by_login(self.filter.get("login"))
-        accounts = self.filter_by_university(
-            self.filter.get("university"), accounts=accounts
-        )
-        accounts = self.filter_by_role(self.filter.get("role"), accounts=accounts)
-        accounts = self.filter_by_status(self.filter.get("status"), accounts=accounts)
-        # Get all accounts if no filter produces anything.
-        if accounts is None:
-            accounts = [
-                row.doc
-                for row in self.db.view(
-                    "account", "all", reduce=False, include_docs=True
-                )
-            ]
-        # This is optimized for retrieval speed. The single-valued
-        # function 'get_account_order_count' is not good enough here.
-        view = self.db.view(
-            "order", "owner", group_level=1, startkey=[""], endkey=[constants.CEILING]
-        )
-        counts = dict([(r.key[0], r.value) for r in view])
+        """Get the accounts for the page given by the filter and paging parameters.
+        Set the total number of accounts matching the filter in the paging.
+        """
+        return self.get_accounts_batch(self.get_account_ids())
+
+    def iter_accounts(self, batch_size=200):
+        """Return a generator of the accounts given by the filter and paging
+        parameters. The total number is set in the paging parameters at once.
+        The account documents and their order counts are fetched in batches.
+        """
+        ids = self.get_account_ids()
+
+        def generator():
+            for start in range(0, len(ids), batch_size):
+                yield from self.get_accounts_batch(ids[start : start + batch_size])
+
+        return generator()
+
+    def get_accounts_batch(self, ids):
+        "Get the accounts given by IUIDs, with order count and name added."
+        accounts = [a for a in self.db.get_bulk(ids) if a is not None]
+        counts = self.get_order_counts([a["email"] for a in accounts])
         for account in accounts:
             account["order_count"] = counts.get(account["email"], 0)
             account["name"] = ", ".join(
@@ -173,82 +218,114 @@ class Accounts(RequestHandler):
             )
         return accounts
 
-    def filter_by_login(self, login):
-        """Return accounts by last login.
-        If no parameter value, assume 'last year'.
-        If 'whenever', then return None; this is handled correctly by later filters.
+    def get_account_ids(self):
+        """Get the IUIDs of the accounts for the page from the index.
+        For each sort, the index has one row for all accounts, and one row
+        each keyed by role, status and university. The key range for one
+        of the filters is used. Any other filters, the '[other]' university,
+        and login last year unless sorted by login, are applied to the index
+        values in that key range; no account documents are read for this.
         """
-        if not login or login == "last year":
+        sort = self.paging["sort"]
+        prefix = [sort, None, None]
+        filters = dict()  # Filters to apply to the index values.
+        # University is the most selective filter, role the least.
+        for pos, key in [(1, "university"), (3, "status"), (2, "role")]:
+            value = self.filter.get(key)
+            if not value:
+                continue
+            if prefix[1] is None and value != "[other]":
+                prefix = [sort, key, value]
+            else:
+                filters[pos] = value
+        # The login filter defaults to 'last year'; 'whenever' means no filter.
+        login = self.filter.get("login") or "last year"
+        since = utils.timestamp(days=-366)  # Allow leap year.
+        if login == "last year":
+            # Login last year is a key range when sorted by login.
+            # For any other sort, that key range is sorted here.
+            startkey = ["login"] + prefix[1:] + [since]
+            endkey = ["login"] + prefix[1:] + [utils.timestamp()]
+        else:
+            startkey = prefix
+            endkey = prefix + [{}]
+        descending = self.paging["order"] == "desc"
+        if descending:
+            startkey, endkey = endkey, startkey
+        kwargs = dict(startkey=startkey, endkey=endkey, descending=descending)
+        offset = self.paging["offset"]
+        limit = self.paging["limit"]
+        if not filters and (login != "last year" or sort == "login"):
+            view = self.db.view("account", "listing", reduce=True, **kwargs)
+            try:
+                self.paging["total"] = list(view)[0].value
+            except IndexError:
+                self.paging["total"] = 0
             view = self.db.view(
-                "account",
-                "login",
-                startkey=utils.timestamp(days=-366),  # Allow leap year.
-                endkey=utils.timestamp(),
-                include_docs=True,
+                "account", "listing", reduce=False, skip=offset, limit=limit, **kwargs
             )
-            return [row.doc for row in view]
-        else:
-            return None
-
-    def filter_by_university(self, university, accounts=None):
-        "Return accounts list if any university filter, or the input accounts if none."
-        if university == "[other]":
-            if accounts is None:
-                accounts = [
-                    row.doc
-                    for row in self.db.view("account", "email", include_docs=True)
-                ]
-            accounts = [
-                a for a in accounts if a["university"] not in settings["UNIVERSITIES"]
-            ]
-        elif university:
-            if accounts is None:
-                accounts = [
-                    row.doc
-                    for row in self.db.view(
-                        "account", "university", key=university, include_docs=True
-                    )
-                ]
-            else:
-                account = [a for a in accounts if a["university"] == university]
-        return accounts
-
-    def filter_by_role(self, role, accounts=None):
-        "Return accounts list if any role filter, or the input accounts if none."
-        if role:
-            if accounts is None:
-                view = self.db.view("account", "role", key=role, include_docs=True)
-                accounts = [r.doc for r in view]
-            else:
-                accounts = [a for a in accounts if a["role"] == role]
-        return accounts
-
-    def filter_by_status(self, status, accounts=None):
-        "Return accounts list if any status filter, or the input if none."
-        if status:
-            if accounts is None:
-                view = self.db.view("account", "status", key=status, include_docs=True)
-                accounts = [r.doc for r in view]
+            return [row.id for row in view]
+        universities = settings["UNIVERSITIES"]
+        rows = []
+        for row in self.db.view("account", "listing", reduce=False, **kwargs):
+            for pos, value in filters.items():
+                if value == "[other]":
+                    if row.value[pos] in universities:
+                        break
+                elif (row.value[pos] or "") != value:
+                    break
             else:
-                accounts = [a for a in accounts if a["status"] == status]
-        return accounts
+                rows.append(row)
+        if login == "last year" and sort != "login":
+            # Value items 'modified' and 'email'; IUID to make it stable.
+            pos = dict(modified=4, email=5)[sort]
+            rows.sort(key=lambda r: (r.value[pos] or "", r.id), reverse=descending)
+        self.paging["total"] = len(rows)
+        if limit is None:
+            return [row.id for row in rows[offset:]]
+        return [row.id for row in rows[offset : offset + limit]]
+
+    def get_order_counts(self, emails):
+        "Get the order counts for the accounts given by email."
+        rows = orderportal.database.get_view_rows(
+            self.db, "order", "owner_count", emails, group=True
+        )
+        return dict([(r.key, r.value) for r in rows])
 
 
-class AccountsApiV1(Accounts):
+class AccountsApiV1(ApiV1Mixin, Accounts):
     "Accounts API; JSON output."
 
-    def get(self):
+    async def get(self):
         "JSON output."
         URL = self.absolute_reverse_url
         self.check_staff()
         self.set_filter()
-        accounts = self.get_accounts()
-        data = utils.get_json(URL("accounts_api", **self.filter), "accounts")
+        self.set_paging()
+        accounts = self.iter_accounts()
+        query = dict(self.filter, sort=self.paging["sort"], order=self.paging["order"])
+        data = utils.get_json(URL("accounts_api", **query), "accounts")
         data["filter"] = self.filter
+        data["paging"] = self.paging
         data["links"] = dict(
             api=dict(href=URL("accounts_api")), display=dict(href=URL("accounts"))
         )
-        data["items"] = []
+        if self.paging["limit"]:
+            offset = self.paging["offset"] + self.paging["limit"]
+            if offset < self.paging["total"]:
+                data["links"]["next"] = dict(
+                    href=URL(
+                        "accounts_api",
+                        offset=offset,
+                        limit=self.paging["limit"],
+                        **query,
+                    )
+                )
+        await self.write_json_items(data, "items", self.get_items(accounts))
+
+    def get_items(self, accounts):
+        "Generate the JSON data for the accounts in the list."
+        URL = self.absolute_reverse_url
         for account in accounts:
             item = dict()
             item["email"] = account["email"]
@@ -285,20 +362,27 @@ class AccountsApiV1(Accounts):
                     api=dict(href=URL("account_orders_api", account["email"])),
                 ),
             )
-            data["items"].append(item)
-        self.write(data)
+            yield item
 
 
 class AccountsCsv(Accounts):
-    "Return a CSV file containing all data for a set of accounts."
+    """Return a CSV file containing all data for a set of accounts.
+    The rows are produced and flushed to the client in batches.
+    """
+
+    export = True
+
+    # Number of rows written to the client at a time.
+    batch_size = 200
 
     @tornado.web.authenticated
-    def get(self):
+    async def get(self):
         "CSV file output."
         self.check_staff()
         self.set_filter()
-        accounts = self.get_accounts()
+        self.set_paging()
         writer = self.get_writer()
+        self.write_headers()
         writer.writerow((settings["SITE_NAME"], utils.today()))
         writer.writerow(
             (
@@ -336,58 +420,68 @@ class AccountsCsv(Accounts):
                 "Created",
             )
         )
-        for account in accounts:
-            addr = account.get("address") or dict()
-            iaddr = account.get("invoice_address") or dict()
-            try:
-                subject = "{0}: {1}".format(
-                    account.get("subject"),
-                    settings["SUBJECT_TERMS_LOOKUP"][account.get("subject")],
-                )
-            except KeyError:
-                subject = ""
-            row = [
-                account["email"],
-                account.get("last_name") or "",
-                account.get("first_name") or "",
-                account["role"],
-                account["status"],
-                account["order_count"],
-                account.get("university") or "",
-                account.get("department") or "",
-                account.get("pi") and "yes" or "no",
-                account.get("orcid") or "",
-                account.get("gender") or "",
-                account.get("group_size") or "",
-                subject,
-                addr.get("university") or "",
-                addr.get("department") or "",
-                addr.get("address") or "",
-                addr.get("zip") or "",
-                addr.get("city") or "",
-                addr.get("country") or "",
-                account.get("invoice_ref") or "",
-                account.get("invoice_vat") or "",
-                iaddr.get("university") or "",
-                iaddr.get("department") or "",
-                iaddr.get("address") or "",
-                iaddr.get("zip") or "",
-                iaddr.get("city") or "",
-                iaddr.get("country") or "",
-                account.get("phone") or "",
-                account.get("other_data") or "",
-                account.get("login") or "",
-                account.get("modified") or "",
-                account.get("created") or "",
-            ]
-            writer.writerow(row)
-        self.write(writer.getvalue())
-        self.write_finish()
+        try:
+            for count, account in enumerate(self.iter_accounts(self.batch_size)):
+                writer.writerow(self.get_row(account))
+                if count % self.batch_size == self.batch_size - 1:
+                    self.write(writer.pop())
+                    await self.flush()
+            for chunk in writer.iter_chunks():
+                self.write(chunk)
+                await self.flush()
+        finally:
+            writer.cleanup()
+
+    def get_row(self, account):
+        "Get the row of values for the account."
+        addr = account.get("address") or dict()
+        iaddr = account.get("invoice_address") or dict()
+        try:
+            subject = "{0}: {1}".format(
+                account.get("subject"),
+                settings["SUBJECT_TERMS_LOOKUP"][account.get("subject")],
+            )
+        except KeyError:
+            subject = ""
+        return [
+            account["email"],
+            account.get("last_name") or "",
+            account.get("first_name") or "",
+            account["role"],
+            account["status"],
+            account["order_count"],
+            account.get("university") or "",
+            account.get("department") or "",
+            account.get("pi") and "yes" or "no",
+            account.get("orcid") or "",
+            account.get("gender") or "",
+            account.get("group_size") or "",
+            subject,
+            addr.get("university") or "",
+            addr.get("department") or "",
+            addr.get("address") or "",
+            addr.get("zip") or "",
+            addr.get("city") or "",
+            addr.get("country") or "",
+            account.get("invoice_ref") or "",
+            account.get("invoice_vat") or "",
+            iaddr.get("university") or "",
+            iaddr.get("department") or "",
+            iaddr.get("address") or "",
+            iaddr.get("zip") or "",
+            iaddr.get("city") or "",
+            iaddr.get("country") or "",
+            account.get("phone") or "",
+            account.get("other_data") or "",
+            account.get("login") or "",
+            account.get("modified") or "",
+            account.get("created") or "",
+        ]
 
     def get_writer(self):
         return utils.CsvWriter()
 
-    def write_finish(self):
+    def write_headers(self):
         self.set_header("Content-Type", constants.CSV_MIMETYPE)
         self.set_header("Content-Disposition", 'attachment; filename="accounts.csv"')
 
@@ -396,9 +490,9 @@ class AccountsXlsx(AccountsCsv):
     "Return an XLSX file containing all data for a set of accounts."
 
     def get_writer(self):
-        return utils.XlsxWriter()
+        return utils.XlsxWriter(constant_memory=True)
 
-    def write_finish(self):
+    def write_headers(self):
         self.set_header("Content-Type", constants.XLSX_MIMETYPE)
         self.set_header("Content-Disposition", 'attachment; filename="accounts.xlsx"')
 
@@ -483,7 +577,8 @@ class Account(AccessMixin, RequestHandler):
         # Delete the logs of the account.
         self.delete_logs(account["_id"])
         # Delete the account itself.
-        self.db.delete(account)
+        orderportal.database.delete_account(self.db, account)
+        directory.remove_account(account)
         self.see_other("accounts")
 
     def allow_delete(self, account):
@@ -497,7 +592,7 @@ class Account(AccessMixin, RequestHandler):
         return False
 
 
-class AccountApiV1(AccessMixin, RequestHandler):
+class AccountApiV1(ApiV1Mixin, AccessMixin, RequestHandler):
     "Account API; JSON output."
 
     @tornado.web.authenticated
@@ -511,6 +606,9 @@ class AccountApiV1(AccessMixin, RequestHandler):
             self.check_readable(account)
         except ValueError as error:
             raise tornado.web.HTTPError(403, reason=error)
+        order_count = self.get_account_order_count(account["email"])
+        if self.check_not_modified([account], order_count):
+            return
         data = utils.get_json(URL("account", email), "account")
         data["email"] = account["email"]
         name = last_name = account.get("last_name")
@@ -541,11 +639,11 @@ class AccountApiV1(AccessMixin, RequestHandler):
         data["login"] = account.get("login", "-")
         data["modified"] = account["modified"]
         data["orders"] = dict(
-            count=self.get_account_order_count(account["email"]),
+            count=order_count,
             display=dict(href=URL("account_orders", account["email"])),
             api=dict(href=URL("account_orders_api", account["email"])),
         )
-        self.write(data)
+        self.write_json(data)
 
 
 class AccountOrdersMixin:
@@ -628,7 +726,7 @@ class AccountOrdersApiV1(AccountOrdersMixin, OrderApiV1Mixin, RequestHandler):
     "Account orders API; JSON output."
 
     @tornado.web.authenticated
-    def get(self, email):
+    async def get(self, email):
         "JSON output."
         URL = self.absolute_reverse_url
         try:
@@ -652,8 +750,19 @@ class AccountOrdersApiV1(AccountOrdersMixin, OrderApiV1Mixin, RequestHandler):
             startkey=[account["email"]],
             endkey=[account["email"], constants.CEILING],
         )
-        data["orders"] = [self.get_order_json(r.doc) for r in view]
-        self.write(data)
+        orders = [r.doc for r in view]
+        if "reports" in self.get_includes():
+            reports_lookup = self.get_reports_lookup(orders)
+        else:
+            reports_lookup = dict()
+        await self.write_json_items(
+            data,
+            "orders",
+            (
+                self.get_order_json(order, reports=reports_lookup.get(order["_id"]))
+                for order in orders
+            ),
+        )
 
 
 class AccountGroupsOrders(AccountOrdersMixin, RequestHandler):
@@ -709,8 +818,14 @@ class AccountGroupsOrdersApiV1(AccountOrdersMixin, OrderApiV1Mixin, RequestHandl
             api=dict(href=URL("account_groups_orders_api", account["email"])),
             display=dict(href=URL("account_groups_orders", account["email"])),
         )
+        orders = self.get_group_orders(account)
+        if "reports" in self.get_includes():
+            reports_lookup = self.get_reports_lookup(orders)
+        else:
+            reports_lookup = dict()
         data["orders"] = [
-            self.get_order_json(order) for order in self.get_group_orders(account)
+            self.get_order_json(order, reports=reports_lookup.get(order["_id"]))
+            for order in orders
         ]
         self.write(data)
 
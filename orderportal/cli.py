@@ -13,6 +13,7 @@ import orderportal.account
 import orderportal.admin
 import orderportal.config
 import orderportal.database
+import orderportal.message
 
 
 @click.group()
@@ -155,6 +156,64 @@ def undump(dumpfile, progressbar):
     click.echo(f"Loaded {ndocs} documents and {nfiles} files.")
 
 
+@cli.command()
+@click.option(
+    "-d",
+    "--days",
+    type=int,
+    help="Archive log entries older than this. Default LOG_ARCHIVE_DAYS.",
+)
+@click.option(
+    "-D",
+    "--dirpath",
+    type=str,
+    help="Write to a gzipped NDJSON file in this directory instead of the archive database.",
+)
+@click.option(
+    "--compact/--no-compact",
+    default=False,
+    help="Compact the database afterwards to reclaim disk space.",
+)
+def archive_logs(days, dirpath, compact):
+    """Move old log entries out of the main database.
+    By default into the database given by LOG_ARCHIVE_DATABASE_NAME,
+    from which the entries are still shown in the web interface.
+    """
+    db = orderportal.database.get_db()
+    orderportal.config.load_settings_from_db(db)
+    orderportal.database.update_design_documents(db)
+    before = db.get_info()["sizes"]["file"]
+    try:
+        count, size = orderportal.database.archive_logs(db, days=days, dirpath=dirpath)
+    except (ValueError, IOError) as error:
+        raise click.ClickException(str(error))
+    click.echo(f"Archived {count} log entries ({size} bytes of JSON).")
+    if compact:
+        db.compact(finish=True)
+        after = db.get_info()["sizes"]["file"]
+        click.echo(f"Database file size reduced by {before - after} bytes.")
+
+
+@cli.command()
+def deliver_messages():
+    """Send the queued email messages that are due.
+    The web server does this periodically; this is for when it is not running.
+    """
+    db = orderportal.database.get_db()
+    orderportal.config.load_settings_from_db(db)
+    orderportal.database.update_design_documents(db)
+    total_sent = 0
+    total_failed = 0
+    while True:
+        sent, failed = orderportal.message.deliver_messages(db)
+        total_sent += sent
+        total_failed += failed
+        if not sent:
+            break
+    orderportal.message.smtp_pool.close_idle(force=True)
+    click.echo(f"Sent {total_sent} messages; {total_failed} failed attempts.")
+
+
 @cli.command()
 @click.argument("email")
 @click.option("--password")  # Get password after account existence check.
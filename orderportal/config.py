@@ -1,5 +1,6 @@
 "Load settings from file and from the database."
 
+import hashlib
 import logging
 import os
 import os.path
@@ -22,12 +23,15 @@ DEFAULT_SETTINGS = dict(
     DATABASE_NAME="orderportal",
     DATABASE_ACCOUNT="orderportal_account",
     DATABASE_PASSWORD=None,
+    LOG_ARCHIVE_DATABASE_NAME=None,  # If set, log documents are archived there.
+    LOG_ARCHIVE_DAYS=365,  # Log documents older than this are archived.
     COOKIE_SECRET=None,
     PASSWORD_SALT=None,
     SETTINGS_FILEPATH=None,  # This value is set on startup.
     SETTINGS_ENVVAR=False,  # This value is set on startup.
     ORDER_IDENTIFIER_FORMAT="OP{0:=05d}",  # Order identifier format; site-unique prefix.
     ORDER_IDENTIFIER_FIRST=1,  # The number to use for the first order.
+    ORDER_IDENTIFIER_BLOCK=1,  # Numbers reserved at a time by each process.
     MAIL_SERVER=None,  # If not set, then no emails can be sent.
     MAIL_DEFAULT_SENDER=None,  # If not set, MAIL_USERNAME will be used.
     MAIL_PORT=25,
@@ -37,6 +41,20 @@ DEFAULT_SETTINGS = dict(
     MAIL_USERNAME=None,
     MAIL_PASSWORD=None,
     MAIL_REPLY_TO=None,
+    MAIL_QUEUE_INTERVAL=10,  # Seconds between checks of the outbound email queue.
+    MAIL_RETRY_DELAY=60,  # Seconds before first retry; doubled for each attempt.
+    MAIL_MAX_ATTEMPTS=8,  # Attempts to send a message before giving up.
+    MAIL_SENDING_TIMEOUT=600,  # Seconds before a message being sent is retried.
+    MAIL_IDLE_TIMEOUT=60,  # Seconds before an unused email connection is closed.
+    MAIL_NOOP_INTERVAL=10,  # Check idle email server connection if unused this long.
+    MAIL_BCC_BATCH_SIZE=50,  # Recipients per survey email; 0 for one email each.
+    MAIL_BATCH_INTERVAL=5,  # Seconds between sending survey email batches.
+    MARKDOWN_CACHE_SIZE=1000,  # Max number of Markdown texts cached as HTML.
+    FRAGMENT_CACHE_SIZE=5000,  # Max number of rendered order fragments cached.
+    SLOW_REQUEST_MS=1000,  # Requests slower than this are logged; 0 to disable.
+    METRICS_DIR=None,  # Directory for the metrics of the processes; default in /tmp.
+    METRICS_INTERVAL=15,  # Seconds between writes of the metrics of a process.
+    METRICS_ALLOWED_IPS=[],  # Access to metrics without login; default none.
 )
 
 
@@ -125,6 +143,40 @@ def load_settings_from_file():
             )
     if not isinstance(settings["ORDER_IDENTIFIER_FIRST"], int):
         raise ValueError("ORDER_IDENTIFIER_FIRST is not an integer")
+    if (
+        not isinstance(settings["ORDER_IDENTIFIER_BLOCK"], int)
+        or settings["ORDER_IDENTIFIER_BLOCK"] < 1
+    ):
+        raise ValueError("ORDER_IDENTIFIER_BLOCK must be a positive integer")
+
+    # Check the outbound email queue settings.
+    for key in (
+        "MAIL_QUEUE_INTERVAL",
+        "MAIL_RETRY_DELAY",
+        "MAIL_MAX_ATTEMPTS",
+        "MAIL_SENDING_TIMEOUT",
+        "MAIL_IDLE_TIMEOUT",
+        "MAIL_NOOP_INTERVAL",
+        "METRICS_INTERVAL",
+    ):
+        if not isinstance(settings[key], int) or settings[key] < 1:
+            raise ValueError(f"{key} must be a positive integer")
+    for key in (
+        "MAIL_BCC_BATCH_SIZE",
+        "MAIL_BATCH_INTERVAL",
+        "MARKDOWN_CACHE_SIZE",
+        "FRAGMENT_CACHE_SIZE",
+        "SLOW_REQUEST_MS",
+    ):
+        if not isinstance(settings[key], int) or settings[key] < 0:
+            raise ValueError(f"{key} must be a non-negative integer")
+
+    # The IP addresses allowed to access metrics may be given as a string.
+    if isinstance(settings["METRICS_ALLOWED_IPS"], str):
+        settings["METRICS_ALLOWED_IPS"] = [
+            ip.strip() for ip in settings["METRICS_ALLOWED_IPS"].split(",")
+        ]
+    settings["METRICS_ALLOWED_IPS"] = settings["METRICS_ALLOWED_IPS"] or []
 
     # Normalize the BASE_URL and BASE_URL_PATH_PREFIX values.
     # BASE_URL must contain only the scheme and netloc parts, with a trailing '/'.
@@ -187,7 +239,11 @@ def load_settings_from_file():
 def load_settings_from_db(db):
     "Load the configurations that are stored in the database into 'settings'."
     logger = logging.getLogger("orderportal")
+    # The settings version identifies the revisions of the configuration
+    # documents loaded; used to key cached rendered fragments.
+    revs = []
     doc = db["order_statuses"]
+    revs.append(doc["_rev"])
     settings["ORDER_STATUSES"] = doc["statuses"]
     settings["ORDER_TRANSITIONS"] = doc["transitions"]
     logger.info("Loaded order statuses configuration from database into 'settings'.")
@@ -204,21 +260,27 @@ def load_settings_from_db(db):
 
     # Site configuration variables and files.
     doc = db["site_configuration"]
+    revs.append(doc["_rev"])
     settings["SITE_NAME"] = doc.get("name") or "OrderPortal"
     settings["SITE_HOST_NAME"] = doc.get("host_name")
     settings["SITE_HOST_URL"] = doc.get("host_url")
     for name in ("icon", "favicon", "image", "css", "host_icon"):
         key = f"SITE_{name.upper()}"
         if doc.get("_attachments", {}).get(name):
+            content_type = doc["_attachments"][name]["content_type"]
+            content = db.get_attachment(doc, name).read()
             settings[key] = dict(
-                content_type=doc["_attachments"][name]["content_type"],
-                content=db.get_attachment(doc, name).read(),
+                content_type=content_type,
+                content=content,
+                digest=utils.get_digest(content),
+                variants=utils.get_compressed_variants(content, content_type),
             )
         else:
             settings[key] = None
     logger.info("Loaded site configuration from database into 'settings'.")
 
     doc = db["order"]
+    revs.append(doc["_rev"])
     settings["ORDER_CREATE_USER"] = doc.get("create_user", True)
     settings["ORDER_AUTOPOPULATE"] = doc.get("autopopulate", {}) or {}
     settings["ORDER_TAGS"] = doc.get("tags", True)
@@ -230,6 +292,7 @@ def load_settings_from_db(db):
     logger.info("Loaded order configuration from database into 'settings'.")
 
     doc = db["orders_list"]
+    revs.append(doc["_rev"])
     settings["ORDERS_LIST_OWNER_UNIVERSITY"] = doc.get("owner_university", False)
     settings["ORDERS_LIST_OWNER_DEPARTMENT"] = doc.get("owner_department", False)
     settings["ORDERS_LIST_OWNER_GENDER"] = doc.get("owner_gender", False)
@@ -243,6 +306,7 @@ def load_settings_from_db(db):
     logger.info("Loaded orders list configuration from database into 'settings'.")
 
     doc = db["account"]
+    revs.append(doc["_rev"])
     settings["ACCOUNT_REGISTRATION_OPEN"] = doc["registration_open"]
     settings["ACCOUNT_PI_INFO"] = doc["pi_info"]
     settings["ACCOUNT_ORCID_INFO"] = doc["orcid_info"]
@@ -262,6 +326,7 @@ def load_settings_from_db(db):
     logger.info("Loaded account configuration from database into 'settings'.")
 
     doc = db["display"]
+    revs.append(doc["_rev"])
     settings["DISPLAY_DEFAULT_PAGE_SIZE"] = doc["default_page_size"]
     settings["DISPLAY_MAX_PENDING_ACCOUNTS"] = doc["max_pending_accounts"]
     settings["DISPLAY_TEXT_MARKDOWN_NOTATION_INFO"] = doc["text_markdown_notation_info"]
@@ -274,6 +339,8 @@ def load_settings_from_db(db):
     settings["DISPLAY_MENU_ABOUT_US"] = doc["menu_about_us"]
     logger.info("Loaded display configuration from database into 'settings'.")
 
+    settings["SETTINGS_VERSION"] = hashlib.sha1(" ".join(revs).encode()).hexdigest()
+
     # Lookup for the enabled statuses: key=identifier, value=item dict.
     settings["ORDER_STATUSES_LOOKUP"] = dict(
         [(s["identifier"], s) for s in settings["ORDER_STATUSES"] if s.get("enabled")]
@@ -297,3 +364,6 @@ def load_texts_from_db(db):
         settings[type] = dict()
         for doc in docs:
             settings[type][doc["name"]] = doc
+    # Pre-render the display texts into the Markdown cache.
+    for doc in settings[constants.DISPLAY].values():
+        utils.markdown2html(doc.get("text"), safe=True)
@@ -1,10 +1,15 @@
 "CouchDB operations."
 
+import copy
+import gzip
+import json
 import logging
+import os.path
 
 import couchdb2
 
 from orderportal import constants, settings
+from orderportal import utils
 
 
 def get_server():
@@ -21,31 +26,47 @@ def get_db():
     return get_server()[settings["DATABASE_NAME"]]
 
 
+def get_archive_db(db, create=False):
+    """Return the handle for the log archive database, or None if not defined.
+    The archive database resides on the same CouchDB server as the main database.
+    If 'create' is True, create the archive database if it does not exist.
+    """
+    name = settings.get("LOG_ARCHIVE_DATABASE_NAME")
+    if not name:
+        return None
+    if create and name not in db.server:
+        db.server.create(name)
+    return couchdb2.Database(db.server, name, check=False)
+
+
 def update_design_documents(db):
     "Ensure that all CouchDB design documents are current."
     logger = logging.getLogger("orderportal")
 
-    if db.put_design("account", ACCOUNT_DESIGN_DOC):
+    if db.put_design("account", copy.deepcopy(ACCOUNT_DESIGN_DOC)):
         logger.info("Updated 'account' CouchDB design document.")
-    if db.put_design("file", FILE_DESIGN_DOC):
+    if db.put_design("file", copy.deepcopy(FILE_DESIGN_DOC)):
         logger.info("Updated 'file' CouchDB design document.")
-    if db.put_design("form", FORM_DESIGN_DOC):
+    if db.put_design("form", copy.deepcopy(FORM_DESIGN_DOC)):
         logger.info("Updated 'form' CouchDB design document.")
-    if db.put_design("group", GROUP_DESIGN_DOC):
+    if db.put_design("group", copy.deepcopy(GROUP_DESIGN_DOC)):
         logger.info("Updated 'group' CouchDB design document.")
-    if db.put_design("info", INFO_DESIGN_DOC):
+    if db.put_design("info", copy.deepcopy(INFO_DESIGN_DOC)):
         logger.info("Updated 'info' CouchDB design document.")
-    if db.put_design("log", LOG_DESIGN_DOC):
+    if db.put_design("log", copy.deepcopy(LOG_DESIGN_DOC)):
         logger.info("Updated 'log' CouchDB design document.")
-    if db.put_design("message", MESSAGE_DESIGN_DOC):
+    archive = get_archive_db(db, create=True)
+    if archive is not None and archive.put_design("log", copy.deepcopy(LOG_DESIGN_DOC)):
+        logger.info("Updated 'log' CouchDB design document in the archive.")
+    if db.put_design("message", copy.deepcopy(MESSAGE_DESIGN_DOC)):
         logger.info("Updated 'message' CouchDB design document.")
-    if db.put_design("meta", META_DESIGN_DOC):
+    if db.put_design("meta", copy.deepcopy(META_DESIGN_DOC)):
         logger.info("Updated 'meta' CouchDB design document.")
-    if db.put_design("order", ORDER_DESIGN_DOC):
+    if db.put_design("order", copy.deepcopy(ORDER_DESIGN_DOC)):
         logger.info("Updated 'order' CouchDB design document.")
-    if db.put_design("report", REPORT_DESIGN_DOC):
+    if db.put_design("report", copy.deepcopy(REPORT_DESIGN_DOC)):
         logger.info("Updated 'report' CouchDB design document.")
-    if db.put_design("text", TEXT_DESIGN_DOC):
+    if db.put_design("text", copy.deepcopy(TEXT_DESIGN_DOC)):
         logger.info("Updated 'text' CouchDB design document.")
 
     # As of version 10.2, the entity types news and event have been scrapped.
@@ -72,6 +93,45 @@ def update_design_documents(db):
         pass
 
 
+def delete_account(db, account):
+    """Delete the account document. The deleted revision retains the doctype
+    and email, allowing the deletion to be identified in the changes feed.
+    """
+    tombstone = dict(
+        _id=account["_id"],
+        _rev=account["_rev"],
+        _deleted=True,
+        email=account["email"],
+    )
+    tombstone[constants.DOCTYPE] = constants.ACCOUNT
+    db.put(tombstone)
+
+
+def delete_form(db, form):
+    """Delete the form document. The deleted revision retains the doctype,
+    allowing the deletion to be identified in the changes feed.
+    """
+    tombstone = dict(_id=form["_id"], _rev=form["_rev"], _deleted=True)
+    tombstone[constants.DOCTYPE] = constants.FORM
+    db.put(tombstone)
+
+
+def delete_order(db, order):
+    """Delete the order document. The deleted revision retains the doctype,
+    owner and identifier, allowing the deletion to be identified in the
+    changes feed.
+    """
+    tombstone = dict(
+        _id=order["_id"],
+        _rev=order["_rev"],
+        _deleted=True,
+        owner=order["owner"],
+        identifier=order.get("identifier"),
+    )
+    tombstone[constants.DOCTYPE] = constants.ORDER
+    db.put(tombstone)
+
+
 def get_count(db, designname, viewname, key=None):
     "Get the reduce value for the name view and the given key."
     if key is None:
@@ -84,6 +144,18 @@ def get_count(db, designname, viewname, key=None):
         return 0
 
 
+def get_view_rows(db, designname, viewname, keys, chunk_size=200, **kwargs):
+    """Get the rows of the named view for the given keys.
+    The keys are sent in the URL of the query, so to avoid exceeding
+    the URL length limits, the view is queried for chunks of the keys.
+    """
+    rows = []
+    for start in range(0, len(keys), chunk_size):
+        chunk = keys[start : start + chunk_size]
+        rows.extend(db.view(designname, viewname, keys=chunk, **kwargs))
+    return rows
+
+
 def get_counts(db):
     "Get the counts for the most important types of entities in the database."
     return dict(
@@ -124,17 +196,127 @@ def lookup_document(db, identifier):
         return None
 
 
-def delete_logs(db, iuid):
-    "Delete the log documents for the given entity IUID."
-    view = db.view(
-        "log",
-        "entity",
-        startkey=[iuid],
-        endkey=[iuid, constants.CEILING],
+def get_logs(db, iuid):
+    """Return the log documents for the given entity IUID, most recent first.
+    Log documents moved to the archive database are included.
+    """
+    kwargs = dict(
+        startkey=[iuid, constants.CEILING],
+        endkey=[iuid],
+        descending=True,
         include_docs=True,
     )
-    for row in view:
-        db.delete(row.doc)
+    logs = [row.doc for row in db.view("log", "entity", **kwargs)]
+    archive = get_archive_db(db)
+    if archive is not None:
+        try:
+            # Archived log documents are always older than those remaining.
+            logs.extend([row.doc for row in archive.view("log", "entity", **kwargs)])
+        except couchdb2.NotFoundError:
+            pass
+    return logs
+
+
+def delete_logs(db, iuid, batch_size=500):
+    """Delete the log documents for the given entity IUID.
+    Also delete those in the archive database, if any.
+    The view is paged through, and deletions are done in bulk for each batch.
+    Return the number of log documents deleted.
+    """
+    count = _delete_entity_logs(db, iuid, batch_size)
+    archive = get_archive_db(db)
+    if archive is not None:
+        try:
+            count += _delete_entity_logs(archive, iuid, batch_size)
+        except couchdb2.NotFoundError:
+            pass
+    return count
+
+
+def _delete_entity_logs(db, iuid, batch_size):
+    "Delete the log documents for the entity in batches, using bulk deletion."
+    count = 0
+    while True:
+        view = db.view(
+            "log",
+            "entity",
+            startkey=[iuid],
+            endkey=[iuid, constants.CEILING],
+            limit=batch_size,
+            include_docs=True,
+        )
+        docs = [dict(_id=row.id, _rev=row.doc["_rev"], _deleted=True) for row in view]
+        if not docs:
+            break
+        deleted = len([r for r in db.update(docs) if r[0]])
+        count += deleted
+        # Stop if at end, or if nothing could be deleted; avoid eternal loop.
+        if len(docs) < batch_size or not deleted:
+            break
+    return count
+
+
+def archive_logs(db, days=None, dirpath=None, batch_size=1000):
+    """Move log documents older than the given number of days out of
+    the main database. They are copied to the archive database, or, if
+    'dirpath' is given, appended to a gzipped NDJSON file in that directory.
+    The log documents are then deleted from the main database in bulk.
+    Return a tuple (number of log documents, bytes of JSON moved).
+    Raise ValueError if no archive destination has been defined.
+    Raise IOError if the log documents could not be stored in the archive.
+    """
+    if days is None:
+        days = settings["LOG_ARCHIVE_DAYS"]
+    cutoff = utils.timestamp(-days)
+    archive = outfile = None
+    if dirpath:
+        filepath = os.path.join(dirpath, f"logs_{utils.today()}.ndjson.gz")
+        outfile = gzip.open(filepath, "at", encoding="utf-8")
+    else:
+        archive = get_archive_db(db, create=True)
+        if archive is None:
+            raise ValueError("no log archive database or directory defined")
+        archive.put_design("log", copy.deepcopy(LOG_DESIGN_DOC))
+    count = 0
+    size = 0
+    try:
+        while True:
+            view = db.view(
+                "log", "modified", endkey=cutoff, limit=batch_size, include_docs=True
+            )
+            docs = [row.doc for row in view]
+            if not docs:
+                break
+            lines = []
+            for doc in docs:
+                data = doc.copy()
+                data.pop("_rev")
+                lines.append(json.dumps(data))
+            if outfile is not None:
+                outfile.write("\n".join(lines) + "\n")
+                outfile.flush()
+            else:
+                copies = [json.loads(line) for line in lines]
+                for result in archive.update(copies):
+                    # Conflict means the document was archived by an earlier run.
+                    if not result[0] and result[2] != "conflict":
+                        raise IOError(f"could not archive log {result[1]}: {result[3]}")
+            results = db.update(
+                [dict(_id=d["_id"], _rev=d["_rev"], _deleted=True) for d in docs]
+            )
+            deleted = set([r[1] for r in results if r[0]])
+            count += len(deleted)
+            size += sum(
+                [len(line) for doc, line in zip(docs, lines) if doc["_id"] in deleted]
+            )
+            # Stop if any could not be deleted; they would be read again,
+            # and so archived again, in an eternal loop.
+            if len(deleted) < len(docs):
+                break
+    finally:
+        if outfile is not None:
+            outfile.close()
+    return count, size
 
 
 ACCOUNT_DESIGN_DOC = {
@@ -157,6 +339,14 @@ ACCOUNT_DESIGN_DOC = {
             "map": """function(doc) {
     if (doc.orderportal_doctype !== 'account') return;
     emit(doc.email, [doc.first_name, doc.last_name]);
+}"""
+        },
+        # For the process-wide account directory; see 'directory.py'.
+        "directory": {
+            "map": """function(doc) {
+    if (doc.orderportal_doctype !== 'account') return;
+    emit(doc.email, [doc.first_name, doc.last_name,
+                     doc.university, doc.department, doc.gender]);
 }"""
         },
         "role": {
@@ -184,7 +374,31 @@ ACCOUNT_DESIGN_DOC = {
     emit(doc.login, doc.email);
 }"""
         },
+        # Composite index for the accounts list: [sort, role, status,
+        # university, sort value], with null meaning any role, status
+        # or university. Any combination of these filters is a key range.
+        "listing": {
+            "reduce": "_count",
+            "map": """function(doc) {
+    if (doc.orderportal_doctype !== 'account') return;
+    var sorts = {modified: doc.modified, email: doc.email, login: doc.login || ''};
+    var value = [doc.login || null, doc.university || null, doc.role, doc.status,
+		 doc.modified, doc.email];
+    for (var sort in sorts) {
+	emit([sort, null, null, sorts[sort]], value);
+	emit([sort, 'role', doc.role, sorts[sort]], value);
+	emit([sort, 'status', doc.status, sorts[sort]], value);
+	emit([sort, 'university', doc.university || '', sorts[sort]], value);
     }
+}""",
+        },
+    },
+    "filters": {
+        # For the changes feed; includes deleted accounts, which retain doctype.
+        "accounts": """function(doc, req) {
+    return doc.orderportal_doctype === 'account';
+}"""
+    },
 }
 
 FILE_DESIGN_DOC = {
@@ -219,7 +433,13 @@ FORM_DESIGN_DOC = {
     emit(doc.modified, doc.title);
 }"""
         },
-    }
+    },
+    "filters": {
+        # For the changes feed; includes deleted forms, which retain doctype.
+        "forms": """function(doc, req) {
+    return doc.orderportal_doctype === 'form';
+}"""
+    },
 }
 
 GROUP_DESIGN_DOC = {
@@ -293,6 +513,12 @@ LOG_DESIGN_DOC = {
     if (doc.orderportal_doctype !== 'log') return;
     if (!doc.changed.login_failure) return;
     emit([doc.entity, doc.modified], doc.changed.login_failure);
+}"""
+        },
+        "modified": {
+            "map": """function(doc) {
+    if (doc.orderportal_doctype !== 'log') return;
+    emit(doc.modified, null);
 }"""
         },
     }
@@ -307,8 +533,32 @@ MESSAGE_DESIGN_DOC = {
     for (var i=0; i<doc.recipients.length; i++) {
 	emit([doc.recipients[i], doc.modified], 1);
     };
+    if (!doc.bcc) return;
+    for (var i=0; i<doc.bcc.length; i++) {
+	emit([doc.bcc[i], doc.modified], 1);
+    };
 }""",
-        }
+        },
+        # Messages waiting to be sent; queued, or claimed for sending.
+        "queue": {
+            "reduce": "_count",
+            "map": """function(doc) {
+    if (doc.orderportal_doctype !== 'message') return;
+    if (doc.status !== 'queued' && doc.status !== 'sending') return;
+    emit(doc.next_attempt, null);
+}""",
+        },
+        # Number of recipients per status for the messages of a mailing.
+        "mailing": {
+            "reduce": "_sum",
+            "map": """function(doc) {
+    if (doc.orderportal_doctype !== 'message') return;
+    if (!doc.mailing) return;
+    var count = doc.recipients.length;
+    if (doc.bcc) count += doc.bcc.length;
+    emit([doc.mailing, doc.status], count);
+}""",
+        },
     }
 }
 
@@ -330,6 +580,14 @@ ORDER_DESIGN_DOC = {
             "map": """function(doc) {
     if (doc.orderportal_doctype !== 'order') return;
     emit([doc.form, doc.modified], 1);
+}""",
+        },
+        "form_owner": {
+            "reduce": "_count",
+            "map": """function(doc) {
+    if (doc.orderportal_doctype !== 'order') return;
+    if (!doc.owner) return;
+    emit([doc.form, doc.owner], 1);
 }""",
         },
         "identifier": {
@@ -350,6 +608,13 @@ ORDER_DESIGN_DOC = {
             "map": """function(doc) {
     if (doc.orderportal_doctype !== 'order') return;
     emit([doc.owner, doc.modified], 1);
+}""",
+        },
+        "owner_count": {
+            "reduce": "_count",
+            "map": """function(doc) {
+    if (doc.orderportal_doctype !== 'order') return;
+    emit(doc.owner, 1);
 }""",
         },
         "status": {
@@ -394,7 +659,13 @@ ORDER_DESIGN_DOC = {
 var lint = {lint};
 """
         },
-    }
+    },
+    "filters": {
+        # For the changes feed; includes deleted orders, which retain doctype.
+        "orders": """function(doc, req) {
+    return doc.orderportal_doctype === 'order';
+}"""
+    },
 }
 
 # Replace variables in the function body according to constants.
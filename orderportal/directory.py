@@ -0,0 +1,211 @@
+"""Process-wide directories of accounts and forms for display lookups.
+Loaded once from the index, and then kept current by saves in this
+process and by the changes feed for saves in other processes.
+The documents and entries held here are shared; they must not be modified.
+"""
+
+import threading
+import time
+
+from orderportal import constants
+
+# Minimum number of seconds between checks of the changes feed.
+REFRESH_INTERVAL = 5.0
+
+
+class Directory:
+    "Base class for a process-wide lookup kept current by the changes feed."
+
+    # Name of the design document filter selecting the relevant documents.
+    filter = None
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.loaded = False
+        self.since = None
+        self.checked = 0.0
+
+    def refresh(self, db):
+        "Load the directory if not done, otherwise apply any recent changes."
+        with self.lock:
+            if not self.loaded:
+                # Get the sequence before the view, so that no change is missed.
+                self.since = db.get_info()["update_seq"]
+                self.load(db)
+                self.loaded = True
+                self.checked = time.monotonic()
+            elif time.monotonic() - self.checked > REFRESH_INTERVAL:
+                self.apply_changes(db)
+                self.checked = time.monotonic()
+
+    def invalidate(self):
+        "Force a reload at the next refresh."
+        with self.lock:
+            self.loaded = False
+
+    def load(self, db):
+        "Load all entries from the index. To be redefined."
+        pass
+
+    def apply_changes(self, db):
+        "Apply the changes since the previous check. To be redefined."
+        pass
+
+
+class AccountDirectory(Directory):
+    "Lookup of account name, university, department and gender by email."
+
+    filter = "account/accounts"
+
+    def __init__(self):
+        super().__init__()
+        self.entries = dict()  # Key: email.
+        self.emails = dict()  # Key: account IUID; to handle deletions.
+
+    def load(self, db):
+        "Load all accounts from the index."
+        entries = dict()
+        emails = dict()
+        for row in db.view("account", "directory"):
+            entries[row.key] = self.get_entry(*row.value)
+            emails[row.id] = row.key
+        self.entries = entries
+        self.emails = emails
+
+    def apply_changes(self, db):
+        "Apply the changes to accounts since the previous check."
+        while True:
+            result = db.changes(filter=self.filter, include_docs=True, since=self.since)
+            for change in result["results"]:
+                doc = change.get("doc")
+                if not doc:
+                    continue
+                if change.get("deleted"):
+                    self.remove(doc)
+                else:
+                    self.update(doc)
+            self.since = result["last_seq"]
+            if not result.get("pending"):
+                break
+
+    def get_entry(self, first_name, last_name, university, department, gender):
+        "Return the directory entry from the account data."
+        return dict(
+            name=", ".join([n for n in [last_name, first_name] if n]),
+            university=university,
+            department=department,
+            gender=gender,
+        )
+
+    def update(self, account):
+        "Update the entry for the account."
+        if not self.loaded:  # Will be up to date when loaded.
+            return
+        email = account.get("email")
+        if not email:
+            return
+        previous = self.emails.get(account["_id"])
+        if previous and previous != email:
+            self.entries.pop(previous, None)
+        self.emails[account["_id"]] = email
+        self.entries[email] = self.get_entry(
+            account.get("first_name"),
+            account.get("last_name"),
+            account.get("university"),
+            account.get("department"),
+            account.get("gender"),
+        )
+
+    def remove(self, account):
+        "Remove the entry for the deleted account."
+        if not self.loaded:
+            return
+        email = self.emails.pop(account["_id"], None) or account.get("email")
+        self.entries.pop(email, None)
+
+    def get(self, email):
+        "Return the entry for the email; an empty dictionary if none."
+        return self.entries.get(email) or dict()
+
+    def get_name(self, email):
+        "Return the name 'last, first' for the email; the email if none."
+        return self.get(email).get("name") or email
+
+
+class FormCatalogue(Directory):
+    """Lookup of form documents by IUID, and the lists of all forms and
+    of enabled forms. Forms are few and change rarely, so any change
+    causes a reload of the whole catalogue.
+    """
+
+    filter = "form/forms"
+
+    def __init__(self):
+        super().__init__()
+        self.forms = dict()  # Key: form IUID.
+        self.all = []  # Most recently modified first.
+        self.enabled = []  # Least recently modified first.
+
+    def load(self, db):
+        "Load all forms from the index."
+        view = db.view("form", "modified", descending=True, include_docs=True)
+        forms = [row.doc for row in view]
+        self.forms = dict([(form["_id"], form) for form in forms])
+        self.all = forms
+        self.enabled = [
+            form for form in reversed(forms) if form["status"] == constants.ENABLED
+        ]
+
+    def apply_changes(self, db):
+        "Reload the catalogue if any form has changed since the previous check."
+        result = db.changes(filter=self.filter, since=self.since, limit=1)
+        if result["results"]:
+            self.since = db.get_info()["update_seq"]
+            self.load(db)
+        else:
+            self.since = result["last_seq"]
+
+    def get(self, iuid):
+        "Return the form document for the IUID; None if none."
+        return self.forms.get(iuid)
+
+    def get_all(self):
+        "Return the list of all forms, most recently modified first."
+        return self.all
+
+    def get_enabled(self):
+        "Return the list of enabled forms, least recently modified first."
+        return self.enabled
+
+
+directory = AccountDirectory()
+catalogue = FormCatalogue()
+
+
+def get_directory(db):
+    "Return the account directory, brought up to date if required."
+    directory.refresh(db)
+    return directory
+
+
+def update_account(account):
+    "Update the directory after the account has been saved in this process."
+    with directory.lock:
+        directory.update(account)
+
+
+def remove_account(account):
+    "Update the directory after the account has been deleted in this process."
+    with directory.lock:
+        directory.remove(account)
+
+
+def get_catalogue(db):
+    "Return the form catalogue, brought up to date if required."
+    catalogue.refresh(db)
+    return catalogue
+
+
+def invalidate_forms():
+    "Force a reload of the form catalogue after a form was saved or deleted."
+    catalogue.invalidate()
@@ -1,5 +1,8 @@
 "Order form fields utility class."
 
+import copy
+import urllib.parse
+
 import tornado.web
 
 from orderportal import constants, settings
@@ -282,3 +285,310 @@ class Fields:
                 return
             if field["type"] == constants.GROUP:
                 self._delete(field["fields"], identifier)
+
+
+class CompiledFields(Fields):
+    """The fields of a specific revision of a form, with precomputed
+    information for handling orders. Shared between requests; read-only!
+    """
+
+    def __init__(self, form):
+        "Use a copy of the form, so that the cached data cannot be modified."
+        super().__init__(copy.deepcopy(form))
+
+    def setup(self):
+        """Flatten the fields, set up the lookup, and precompute
+        the visibility conditions and the table column definitions.
+        """
+        self.flat = super().flatten()
+        self._lookup = dict([(f["identifier"], f) for f in self.flat])
+        # Key: field identifier; value: (select field identifier,
+        # lower-case value, list of lower-case alternative values).
+        self.conditions = dict()
+        # Key: field identifier; value: list of table column definitions.
+        self.coldefs = dict()
+        for field in self.flat:
+            if field.get("visible_if_field"):
+                value = field.get("visible_if_value")
+                self.conditions[field["identifier"]] = (
+                    field["visible_if_field"],
+                    value and value.lower(),
+                    str(value).lower().split("|"),
+                )
+            if field["type"] == constants.TABLE:
+                self.coldefs[field["identifier"]] = [
+                    utils.parse_field_table_column(c) for c in field["table"]
+                ]
+        # The validation plan: validator for each non-group field,
+        # subfields of each group, and fields depending on a select field.
+        self.validators = dict()
+        self.subfields = dict()
+        self.dependents = dict()
+        for field in self.flat:
+            identifier = field["identifier"]
+            if field["type"] == constants.GROUP:
+                self.subfields[identifier] = [f["identifier"] for f in field["fields"]]
+            else:
+                self.validators[identifier] = get_validator(field)
+            if identifier in self.conditions:
+                select_id = self.conditions[identifier][0]
+                self.dependents.setdefault(select_id, []).append(identifier)
+
+    def flatten(self, fields=None, depth=0, parent=None):
+        "Return the precomputed list of all fields, unless for a subtree."
+        if fields is None:
+            return list(self.flat)
+        return super().flatten(fields=fields, depth=depth, parent=parent)
+
+    def is_visible(self, identifier, values):
+        """Is the field visible given the values of the other fields?
+        Does not consider the visibility of any group the field belongs to.
+        """
+        try:
+            select_id, if_value, alternatives = self.conditions[identifier]
+        except KeyError:
+            return True
+        return str(values.get(select_id)).lower() in alternatives
+
+    def get_affected(self, identifiers):
+        """Return the set of identifiers for the given fields, the fields
+        whose visibility depends on them, the subfields of all these,
+        and the groups containing any of them.
+        """
+        result = set()
+        stack = list(identifiers)
+        while stack:
+            identifier = stack.pop()
+            if identifier in result or identifier not in self._lookup:
+                continue
+            result.add(identifier)
+            stack.extend(self.dependents.get(identifier, []))
+            stack.extend(self.subfields.get(identifier, []))
+        for identifier in list(result):
+            parent = self._lookup[identifier]["parent"]
+            while parent is not None and parent not in result:
+                result.add(parent)
+                parent = self._lookup[parent]["parent"]
+        return result
+
+    def check_validity(self, values, invalid, identifiers=None):
+        """Check the validity of the field values, and convert some of them.
+        The 'values' and 'invalid' dictionaries are modified in place.
+        If 'identifiers' is given, then check only the fields affected by
+        changes in those; the entries in 'invalid' for other fields are kept.
+        A field that is not visible is skipped, along with its subfields.
+        """
+        if identifiers is None:
+            affected = self._lookup
+            invalid.clear()
+        else:
+            affected = self.get_affected(identifiers)
+            for identifier in affected:
+                invalid.pop(identifier, None)
+        # Pre-order pass to determine hidden fields.
+        hidden = set()
+        for field in self.flat:
+            identifier = field["identifier"]
+            if field["parent"] in hidden:
+                hidden.add(identifier)
+            else:
+                try:
+                    select_id, if_value = self.conditions[identifier][:2]
+                except KeyError:
+                    continue
+                select_value = values.get(select_id)
+                if select_value is not None:
+                    select_value = str(select_value).lower()
+                if select_value != if_value:
+                    hidden.add(identifier)
+        # Reverse pre-order pass; subfields are checked before their group.
+        for field in reversed(self.flat):
+            identifier = field["identifier"]
+            if identifier not in affected or identifier in hidden:
+                continue
+            try:
+                if field["type"] == constants.GROUP:
+                    for subfield in self.subfields[identifier]:
+                        if subfield in invalid and subfield not in hidden:
+                            raise ValueError("subfield(s) invalid")
+                else:
+                    values[identifier] = self.validators[identifier](values[identifier])
+            except ValueError as error:
+                invalid[identifier] = str(error)
+            except Exception as error:
+                invalid[identifier] = f"System error: {error}"
+
+
+def get_validator(field):
+    """Return a function that checks the value for the field.
+    It returns the value, converted if required by the field type.
+    Raise ValueError if the value is invalid.
+    """
+    required = field["required"]
+    check = VALIDATOR_FACTORIES.get(field["type"], get_any_validator)(field)
+
+    def validator(value):
+        if value is None:
+            if required:
+                raise ValueError("missing value")
+            return value
+        return check(value)
+
+    return validator
+
+
+def get_any_validator(field):
+    return lambda value: value
+
+
+def get_email_validator(field):
+    def validator(value):
+        if not constants.EMAIL_RX.match(value):
+            raise ValueError("not a valid email address")
+        return value
+
+    return validator
+
+
+def get_int_validator(field):
+    def validator(value):
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            raise ValueError("not an integer value")
+
+    return validator
+
+
+def get_float_validator(field):
+    def validator(value):
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            raise ValueError("not a float value")
+
+    return validator
+
+
+def get_boolean_validator(field):
+    def validator(value):
+        try:
+            return utils.to_bool(value)
+        except (TypeError, ValueError):
+            raise ValueError("not a boolean value")
+
+    return validator
+
+
+def get_url_validator(field):
+    def validator(value):
+        parsed = urllib.parse.urlparse(value)
+        if not (parsed.scheme and parsed.netloc):
+            raise ValueError("incomplete URL")
+        return value
+
+    return validator
+
+
+def get_select_validator(field):
+    alternatives = frozenset(field["select"])
+
+    def validator(value):
+        try:
+            if value in alternatives:
+                return value
+        except TypeError:  # Unhashable value.
+            pass
+        raise ValueError("value not among alternatives")
+
+    return validator
+
+
+def get_multiselect_validator(field):
+    required = field["required"]
+    alternatives = frozenset(field["multiselect"])
+
+    def validator(value):
+        if not isinstance(value, list):
+            raise ValueError("value is not a list")
+        if required and len(value) == 1 and value[0] == "":
+            raise ValueError("missing value")
+        for v in value:
+            try:
+                if not v or v in alternatives:
+                    continue
+            except TypeError:  # Unhashable value.
+                pass
+            raise ValueError("value not among alternatives")
+        return value
+
+    return validator
+
+
+def get_text_validator(field):
+    def validator(value):
+        if not isinstance(value, str):
+            raise ValueError("value is not a text string")
+        return value
+
+    return validator
+
+
+def get_date_validator(field):
+    def validator(value):
+        if not constants.DATE_RX.match(value):
+            raise ValueError("value is not a valid date")
+        return value
+
+    return validator
+
+
+def get_table_validator(field):
+    required = field["required"]
+
+    def validator(value):
+        if not isinstance(value, list):
+            raise ValueError("table value is not a list")
+        if required and len(value) == 0:
+            raise ValueError("missing data")
+        for row in value:
+            if not isinstance(row, list):
+                raise ValueError("table value is not a list of lists")
+        return value
+
+    return validator
+
+
+# Key: field type; value: function returning a validator for a field of that type.
+VALIDATOR_FACTORIES = {
+    constants.EMAIL: get_email_validator,
+    constants.INT: get_int_validator,
+    constants.FLOAT: get_float_validator,
+    constants.BOOLEAN: get_boolean_validator,
+    constants.URL: get_url_validator,
+    constants.SELECT: get_select_validator,
+    constants.MULTISELECT: get_multiselect_validator,
+    constants.TEXT: get_text_validator,
+    constants.DATE: get_date_validator,
+    constants.TABLE: get_table_validator,
+}
+
+
+# Process-wide cache of compiled fields; key: form (_id, _rev).
+_compiled_fields = dict()
+
+
+def get_compiled_fields(form):
+    """Return the compiled fields for the form, from the cache if possible.
+    The compiled fields for any other revision of the form are discarded.
+    """
+    if "_rev" not in form:  # Not saved; do not cache.
+        return CompiledFields(form)
+    key = (form["_id"], form["_rev"])
+    try:
+        return _compiled_fields[key]
+    except KeyError:
+        for other in [k for k in _compiled_fields if k[0] == form["_id"]]:
+            _compiled_fields.pop(other)
+        result = _compiled_fields[key] = CompiledFields(form)
+        return result
@@ -5,11 +5,13 @@ import json
 import tornado.web
 
 from orderportal import constants, settings
+from orderportal import directory
 from orderportal import saver
 from orderportal import utils
 from orderportal.fields import Fields
 from orderportal.requesthandler import RequestHandler, ApiV1Mixin
-from orderportal.message import MessageSaver
+from orderportal.message import get_mailing_progress, queue_mailing
+import orderportal.database
 
 
 class FormSaver(saver.Saver):
@@ -23,6 +25,10 @@ class FormSaver(saver.Saver):
     def setup(self):
         self.fields = Fields(self.doc)
 
+    def post_process(self):
+        "Invalidate the form catalogue of this process."
+        directory.invalidate_forms()
+
     def add_field(self):
         identifier = self.handler.get_argument("identifier")
         if not constants.ID_RX.match(identifier):
@@ -77,20 +83,16 @@ class FormMixin:
             return 0
 
     def get_order_emails(self, form):
-        "Return a list of emails for orders for the form."
+        "Return a list of emails for owners of orders for the form."
         view = self.db.view(
             "order",
-            "form",
+            "form_owner",
             startkey=[form["_id"]],
             endkey=[form["_id"], constants.CEILING],
-            include_docs=True,
+            reduce=True,
+            group=True,
         )
-        # set to avoid duplicates (if one user has filled multiple orders)
-        emails = set()
-        emails.update(v.doc["owner"] for v in view if "owner" in v.doc)
-
-        # return a list
-        return list(emails)
+        return [row.key[1] for row in view]
 
 
 class Forms(FormMixin, RequestHandler):
@@ -99,9 +101,8 @@ class Forms(FormMixin, RequestHandler):
     @tornado.web.authenticated
     def get(self):
         self.check_admin()
-        view = self.db.view("form", "modified", descending=True, include_docs=True)
         title = "Recent forms"
-        forms = [r.doc for r in view]
+        forms = self.get_form_catalogue().get_all()
         counts = dict([(f["_id"], self.get_order_count(f)) for f in forms])
         self.render(
             "form/list.html",
@@ -130,8 +131,15 @@ class Form(FormMixin, RequestHandler):
             allow_delete=self.allow_delete(form),
             allow_edit_fields=self.allow_edit_fields(form),
             logs=self.get_logs(form["_id"]),
+            survey_progress=self.get_survey_progress(form),
         )
 
+    def get_survey_progress(self, form):
+        "Return the number of recipients per status for the survey mailing, if any."
+        if not form.get("survey_mailing"):
+            return None
+        return get_mailing_progress(self.db, form["survey_mailing"])
+
     @tornado.web.authenticated
     def post(self, iuid):
         if self.get_argument("_http_method", None) == "delete":
@@ -147,7 +155,8 @@ class Form(FormMixin, RequestHandler):
             self.see_other("form", form["_id"], error="Form cannot be deleted.")
             return
         self.delete_logs(form["_id"])
-        self.db.delete(form)
+        orderportal.database.delete_form(self.db, form)
+        directory.invalidate_forms()
         self.see_other("forms")
 
     def allow_delete(self, form):
@@ -164,9 +173,18 @@ class Form(FormMixin, RequestHandler):
 class FormApiV1(ApiV1Mixin, Form):
     "Form API; JSON."
 
-    def render(self, templatefilename, **kwargs):
+    @tornado.web.authenticated
+    def get(self, iuid):
+        self.check_admin()
+        try:
+            form = self.get_form(iuid)
+        except tornado.web.HTTPError:
+            self.see_other("home", error="Sorry, no such form.")
+            return
+        order_count = self.get_order_count(form)
+        if self.check_not_modified([form], order_count):
+            return
         URL = self.absolute_reverse_url
-        form = kwargs["form"]
         data = dict()
         data["type"] = "form"
         data["iuid"] = form["_id"]
@@ -190,12 +208,12 @@ class FormApiV1(ApiV1Mixin, Form):
             display=dict(href=URL("form", form["_id"])),
         )
         data["orders"] = dict(
-            count=self.get_order_count(form),
+            count=order_count,
             # XXX Add API href when available.
             display=dict(href=URL("form_orders", form["_id"])),
         )
         data["fields"] = form["fields"]
-        self.write(data)
+        self.write_json(data)
 
 
 class FormLogs(FormMixin, RequestHandler):
@@ -303,8 +321,8 @@ class FormFieldCreate(FormMixin, RequestHandler):
             return
         # Get existing field identifiers
         identifiers = set()
-        for row in self.db.view("form", "enabled", include_docs=True):
-            identifiers.update(self._get_identifiers(row.doc["fields"]))
+        for enabled in self.get_form_catalogue().get_enabled():
+            identifiers.update(self._get_identifiers(enabled["fields"]))
         identifiers.difference_update(self._get_identifiers(form["fields"]))
         self.render(
             "form/field_create.html",
@@ -479,7 +497,8 @@ class FormEmailSender(FormMixin, RequestHandler):
         # Get recipients
         recipients = self.get_order_emails(form)
         owner = form.get("owner", None)
-        recipients.append(owner)  # Add form owner to the list of recipients
+        if owner:
+            recipients.append(owner)  # Add form owner to the list of recipients
 
         # Prepare email content
         site = settings.get("SITE_NAME") or "OrderPortal"
@@ -498,19 +517,29 @@ The {site} administrators.
         )
         subject = "Email from {site} - Survey".format(site=site)
 
-        # send email
-        with MessageSaver(handler=self) as saver:
-            saver.create({"subject": subject, "text": text})
-            saver.send(recipients=recipients)
+        # Queue the email in batches; sent in the background.
+        mailing = utils.get_iuid()
+        try:
+            count = queue_mailing(
+                self, {"subject": subject, "text": text}, recipients, mailing
+            )
+        except ValueError as error:
+            self.see_other("form", form["_id"], error=error)
+            return
 
-        # set survey_sent to True
+        # set survey_sent to True, and record the mailing for progress.
         with FormSaver(doc=form, handler=self) as saver:
             saver["survey_sent"] = True
+            saver["survey_mailing"] = mailing
 
         # Log that survey has been sent
         utils.log(self.db, self, form, changed={ 'recipients': recipients })
-        # redirect back to form page
-        self.redirect(self.absolute_reverse_url("form", iuid))
+        self.see_other(
+            "form",
+            iuid,
+            message=f"Survey queued for {len(recipients)} recipients"
+            f" in {count} emails.",
+        )
 
 
 class FormPending(FormMixin, RequestHandler):
@@ -535,7 +564,7 @@ class FormPending(FormMixin, RequestHandler):
         )
         for row in view:
             self.delete_logs(row.id)
-            self.db.delete(row.doc)
+            orderportal.database.delete_order(self.db, row.doc)
         self.see_other("form", iuid)
 
 
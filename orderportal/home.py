@@ -13,6 +13,7 @@ import yaml
 
 import orderportal
 import orderportal.database
+import orderportal.metrics
 from orderportal import constants, settings
 from orderportal import saver
 from orderportal import utils
@@ -24,11 +25,10 @@ class Home(RequestHandler):
 
     def get(self):
         "Home page; contents depends on the role of the logged-in account, if any."
-        forms = [row.doc for row in self.db.view("form", "enabled", include_docs=True)]
-        for form in forms:
-            if form.get("ordinal") is None:
-                form["ordinal"] = 0
-        forms.sort(key=lambda i: i["ordinal"])
+        forms = sorted(
+            self.get_form_catalogue().get_enabled(),
+            key=lambda i: i.get("ordinal") or 0,
+        )
         if not self.current_user:
             self.render("home/anonymous.html", forms=forms)
         elif self.current_user["role"] == constants.ADMIN:
@@ -178,7 +178,10 @@ class Entity(RequestHandler):
 
 
 class SiteFile(RequestHandler):
-    "Return a file configured for the site."
+    """Return a file configured for the site. The browser may keep it for long
+    if the URL contains the current version, otherwise it must revalidate it
+    using the ETag. A compressed variant is sent if accepted by the browser.
+    """
 
     def get(self, name):
         try:
@@ -187,9 +190,118 @@ class SiteFile(RequestHandler):
                 raise KeyError
         except KeyError:
             raise tornado.web.HTTPError(404)
+        encoding = utils.get_accepted_encoding(self.request, data["variants"])
+        self.set_header("Content-Type", data["content_type"])
+        self.set_header("Vary", "Accept-Encoding")
+        if self.get_argument("v", None) == data["digest"]:
+            self.set_header(
+                "Cache-Control",
+                f"public, max-age={constants.STATIC_MAX_AGE}, immutable",
+            )
+        else:
+            self.set_header("Cache-Control", "no-cache")
+        if encoding:
+            self.set_header("ETag", f'"{data["digest"]}-{encoding}"')
+        else:
+            self.set_header("ETag", f'"{data["digest"]}"')
+        if self.check_etag_header():
+            self.set_status(304)
+            return
+        if encoding:
+            self.set_header("Content-Encoding", encoding)
+            self.write(data["variants"][encoding])
         else:
             self.write(data["content"])
-            self.set_header("Content-Type", data["content_type"])
+
+
+class StaticFile(tornado.web.StaticFileHandler):
+    """Return a file from the packaged 'static' directory. The URLs contain
+    the version, so tornado allows the browser to keep the file for long.
+    A precompressed variant is sent if accepted by the browser; the variants
+    are computed when first requested, and kept for the process.
+    """
+
+    # Key: (absolute path, version); value: dictionary of variants.
+    variants = dict()
+
+    async def get(self, path, include_body=True):
+        self.encoding = None
+        # Byte ranges refer to the original content; let tornado handle it.
+        if self.request.headers.get("Range"):
+            await super().get(path, include_body=include_body)
+            return
+        self.path = self.parse_url_path(path)
+        absolute_path = self.get_absolute_path(self.root, self.path)
+        self.absolute_path = self.validate_absolute_path(self.root, absolute_path)
+        if self.absolute_path is None:
+            return
+        variants = self.get_variants()
+        self.encoding = utils.get_accepted_encoding(self.request, variants)
+        if self.encoding is None:
+            await super().get(path, include_body=include_body)
+            return
+        self.modified = self.get_modified_time()
+        self.set_headers()
+        if self.should_return_304():
+            self.set_status(304)
+            return
+        content = variants[self.encoding]
+        self.set_header("Content-Length", len(content))
+        if include_body:
+            self.write(content)
+
+    def get_variants(self):
+        "Return the compressed variants of the file for the current version."
+        key = (self.absolute_path, self._get_cached_version(self.absolute_path))
+        try:
+            return self.variants[key]
+        except KeyError:
+            content_type = self.get_content_type()
+            if content_type in constants.COMPRESSIBLE_MIMETYPES:
+                with open(self.absolute_path, "rb") as infile:
+                    content = infile.read()
+                result = utils.get_compressed_variants(content, content_type)
+            else:
+                result = dict()
+            self.variants[key] = result
+            return result
+
+    def compute_etag(self):
+        "Distinguish the ETag of a compressed variant."
+        etag = super().compute_etag()
+        if etag and self.encoding:
+            etag = f'{etag[:-1]}-{self.encoding}"'
+        return etag
+
+    def set_extra_headers(self, path):
+        "Set the headers for the encoding, and mark versioned files immutable."
+        self.set_header("Vary", "Accept-Encoding")
+        if self.encoding:
+            self.set_header("Content-Encoding", self.encoding)
+        if self.get_argument("v", None):
+            self.set_header(
+                "Cache-Control",
+                f"public, max-age={constants.STATIC_MAX_AGE}, immutable",
+            )
+
+
+class Metrics(RequestHandler):
+    """Metrics for all processes of the server, in Prometheus text format.
+    Accessible from the allowed IP addresses, or by an admin.
+    """
+
+    def get(self):
+        # The address of the socket peer; 'remote_ip' may be set from headers.
+        try:
+            address = self.request.connection.context.address[0]
+        except (AttributeError, TypeError, IndexError):
+            address = None
+        if address not in settings["METRICS_ALLOWED_IPS"]:
+            if not self.am_admin():
+                raise tornado.web.HTTPError(403)
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.set_header("Cache-Control", "no-cache")
+        self.write(orderportal.metrics.get_text(self.db))
 
 
 class NoSuchEntity(RequestHandler):
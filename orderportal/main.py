@@ -17,6 +17,8 @@ import orderportal.file
 import orderportal.form
 import orderportal.group
 import orderportal.info
+import orderportal.message
+import orderportal.metrics
 import orderportal.home
 import orderportal.order
 import orderportal.report
@@ -88,6 +90,26 @@ def get_handlers():
         ),
         url(r"/orders", orderportal.order.Orders, name="orders"),
         url(r"/api/v1/orders", orderportal.order.OrdersApiV1, name="orders_api"),
+        url(
+            r"/orders/transition",
+            orderportal.order.OrdersTransition,
+            name="orders_transition",
+        ),
+        url(
+            r"/api/v1/orders/transition",
+            orderportal.order.OrdersTransitionApiV1,
+            name="orders_transition_api",
+        ),
+        url(
+            r"/api/v1/orders/bulk",
+            orderportal.order.OrdersBulkApiV1,
+            name="orders_bulk_api",
+        ),
+        url(
+            r"/api/v1/orders/sync",
+            orderportal.order.OrdersSyncApiV1,
+            name="orders_sync_api",
+        ),
         url(r"/orders.csv", orderportal.order.OrdersCsv, name="orders_csv"),
         url(r"/orders.xlsx", orderportal.order.OrdersXlsx, name="orders_xlsx"),
         url(r"/report", orderportal.report.ReportAdd, name="report_add"),
@@ -358,6 +380,7 @@ def get_handlers():
         url(r"/admin/settings", orderportal.admin.Settings, name="admin_settings"),
         url(r"/search", orderportal.search.Search, name="search"),
         url(r"/site/([^/]+)", orderportal.home.SiteFile, name="site"),
+        url(r"/metrics", orderportal.home.Metrics, name="metrics"),
         url(r"/api/v1/(.*)", orderportal.home.NoSuchEntityApiV1),
         url(r"/(.*)", orderportal.home.NoSuchEntity),
     ]
@@ -377,8 +400,10 @@ def main():
     else:
         login_url = constants.LOGIN_URL
 
+    handlers = get_handlers()
+    orderportal.metrics.registry.set_handler_names(handlers)
     application = tornado.web.Application(
-        handlers=get_handlers(),
+        handlers=handlers,
         debug=settings.get("TORNADO_DEBUG", False),
         autoreload=settings.get("TORNADO_DEBUG", False),
         cookie_secret=settings["COOKIE_SECRET"],
@@ -386,9 +411,12 @@ def main():
         ui_modules=orderportal.uimodules,
         template_path=constants.TEMPLATE_DIR,
         static_path=constants.STATIC_DIR,
+        static_handler_class=orderportal.home.StaticFile,
         login_url=login_url,
     )
     application.listen(settings["PORT"], xheaders=True)
+    orderportal.message.start_delivery()
+    orderportal.metrics.start_snapshots()
 
     # Add href URLs for the status icons.
     for key, value in settings["ORDER_STATUSES_LOOKUP"].items():
@@ -1,57 +1,235 @@
-"Message to account email address; store and send."
+"""Message to account email address; store and send.
+The message documents form a queue of outbound email. The request only
+stores the message, which is sent by a background delivery worker.
+"""
 
 import email.message
+import logging
 import smtplib
+import threading
+import time
+
+import couchdb2
+import tornado.ioloop
 
 from orderportal import constants, settings
 from orderportal import saver
 from orderportal import utils
+import orderportal.database
+import orderportal.profiling
+
+# State of the background delivery worker in this process.
+_delivery = dict(running=False, pending=False)
+
+
+def connect():
+    """Connect and login to the email server. Return the SMTP connection.
+    Raises KeyError if email server is badly configured.
+    Raises ValueError if some other problem.
+    """
+    server = settings["MAIL_SERVER"]
+    if not server:
+        raise KeyError("Email server not configured.")
+    port = int(settings["MAIL_PORT"])
+    use_ssl = utils.to_bool(settings["MAIL_USE_SSL"])
+    use_tls = utils.to_bool(settings["MAIL_USE_TLS"])
+    if use_tls:
+        connection = smtplib.SMTP(server, port=port)
+        if settings.get("MAIL_EHLO"):
+            connection.ehlo(settings["MAIL_EHLO"])
+        connection.starttls()
+        if settings.get("MAIL_EHLO"):
+            connection.ehlo(settings["MAIL_EHLO"])
+    elif use_ssl:
+        connection = smtplib.SMTP_SSL(server, port=port)
+    else:
+        connection = smtplib.SMTP(server, port=port)
+    try:
+        username = settings["MAIL_USERNAME"]
+        if not username:
+            raise KeyError
+        password = settings["MAIL_PASSWORD"]
+        if not password:
+            raise KeyError
+    except KeyError:
+        pass
+    else:
+        connection.login(username, password)
+    return connection
+
+
+class SmtpPool:
+    """Process-wide pool of authenticated connections to the email server.
+    A connection is kept alive after use, to be reused by the next session.
+    Idle connections are closed after MAIL_IDLE_TIMEOUT seconds, and checked
+    with NOOP before being reused after more than MAIL_NOOP_INTERVAL seconds.
+    """
+
+    # Maximum number of idle connections kept.
+    max_idle = 2
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.idle = []  # List of tuples (connection, time of last use).
+        self.connects = 0
+        self.reuses = 0
+
+    def acquire(self):
+        "Return a live connection; reuse an idle one if possible."
+        while True:
+            with self.lock:
+                try:
+                    connection, last_used = self.idle.pop()
+                except IndexError:
+                    break
+            idle = time.monotonic() - last_used
+            if idle > settings["MAIL_IDLE_TIMEOUT"]:
+                self.close(connection)
+                continue
+            if idle > settings["MAIL_NOOP_INTERVAL"]:
+                try:
+                    if connection.noop()[0] != 250:
+                        raise smtplib.SMTPException("bad NOOP response")
+                except (smtplib.SMTPException, OSError):
+                    self.close(connection)
+                    continue
+            self.reuses += 1
+            return connection
+        connection = connect()
+        self.connects += 1
+        return connection
+
+    def release(self, connection):
+        "Return the connection to the pool after successful use."
+        with self.lock:
+            if len(self.idle) < self.max_idle:
+                self.idle.append((connection, time.monotonic()))
+                return
+        self.close(connection)
+
+    def close(self, connection):
+        "Close the connection, ignoring any errors."
+        try:
+            connection.quit()
+        except (smtplib.SMTPException, OSError):
+            try:
+                connection.close()
+            except OSError:
+                pass
+
+    def close_idle(self, force=False):
+        "Close the connections that have been idle too long, or all if forced."
+        now = time.monotonic()
+        with self.lock:
+            if force:
+                expired = self.idle
+                self.idle = []
+            else:
+                expired = [
+                    i for i in self.idle if now - i[1] > settings["MAIL_IDLE_TIMEOUT"]
+                ]
+                self.idle = [i for i in self.idle if i not in expired]
+        for connection, last_used in expired:
+            self.close(connection)
+
+
+smtp_pool = SmtpPool()
+
+
+class MailSession:
+    """Context manager for sending several messages using one connection
+    to the email server, taken from the pool when first needed and returned
+    to it on exit. A connection that has been dropped by the server is
+    replaced once per message.
+    """
+
+    def __init__(self):
+        self.server = None
+        self.error = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, tb):
+        if type is not None:
+            self.discard()
+        elif self.server is not None:
+            smtp_pool.release(self.server)
+            self.server = None
+        return False
+
+    def get_server(self):
+        """Return the connection to the email server; get it if not done.
+        A failure to connect is not retried within the session.
+        """
+        if self.error is not None:
+            raise self.error
+        if self.server is None:
+            try:
+                self.server = smtp_pool.acquire()
+            except (ValueError, TypeError, KeyError, OSError) as error:
+                self.error = error
+                raise
+        return self.server
+
+    def discard(self):
+        "Close the current connection, which is not to be reused."
+        if self.server is not None:
+            smtp_pool.close(self.server)
+            self.server = None
+
+    def send(self, doc):
+        "Send the message document."
+        message = email.message.EmailMessage()
+        message["From"] = doc["sender"]
+        message["Subject"] = doc["subject"]
+        if doc.get("reply-to"):
+            message["Reply-To"] = doc["reply-to"]
+        if doc["recipients"]:
+            message["To"] = ", ".join(set(doc["recipients"]))
+        else:
+            message["To"] = "undisclosed-recipients:;"
+        # The Bcc header is used for the envelope, but is not transmitted.
+        if doc.get("bcc"):
+            message["Bcc"] = ", ".join(set(doc["bcc"]))
+        message.set_content(doc["text"])
+        try:
+            with orderportal.profiling.timer("smtp"):
+                self.get_server().send_message(message)
+        except smtplib.SMTPServerDisconnected:
+            self.discard()
+            with orderportal.profiling.timer("smtp"):
+                self.get_server().send_message(message)
+        except smtplib.SMTPException as error:
+            # Recipient errors leave the connection usable; others may not.
+            if not isinstance(
+                error, (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused)
+            ):
+                self.discard()
+            raise
+        except OSError:
+            self.discard()
+            raise
 
 
 class MessageSaver(saver.Saver):
     doctype = constants.MESSAGE
 
     def initialize(self):
-        """Connect to the email server.
+        """Check that the email server is configured.
         Raises KeyError if email server is badly configured.
         Raises ValueError if some other problem.
         """
         super().initialize()
         try:
-            server = settings["MAIL_SERVER"]
-            if not server:
+            if not settings["MAIL_SERVER"]:
                 raise KeyError("Email server not configured.")
             sender = settings["MAIL_DEFAULT_SENDER"] or settings["MAIL_USERNAME"]
             if not sender:
                 raise KeyError("Email server badly configured.")
-            port = int(settings["MAIL_PORT"])
-            use_ssl = utils.to_bool(settings["MAIL_USE_SSL"])
-            use_tls = utils.to_bool(settings["MAIL_USE_TLS"])
-            if use_tls:
-                self.server = smtplib.SMTP(server, port=port)
-                if settings.get("MAIL_EHLO"):
-                    self.server.ehlo(settings["MAIL_EHLO"])
-                self.server.starttls()
-                if settings.get("MAIL_EHLO"):
-                    self.server.ehlo(settings["MAIL_EHLO"])
-            elif use_ssl:
-                self.server = smtplib.SMTP_SSL(server, port=port)
-            else:
-                self.server = smtplib.SMTP(server, port=port)
-            try:
-                username = settings["MAIL_USERNAME"]
-                if not username:
-                    raise KeyError
-                password = settings["MAIL_PASSWORD"]
-                if not password:
-                    raise KeyError
-            except KeyError:
-                pass
-            else:
-                self.server.login(username, password)
             self["sender"] = sender
             self["reply-to"] = settings["MAIL_REPLY_TO"]
-        except (ValueError, TypeError, KeyError, smtplib.SMTPException) as error:
+        except (ValueError, TypeError, KeyError) as error:
             self.handle_error(error)
 
     def create(self, text_container, **kwargs):
@@ -70,8 +248,9 @@ class MessageSaver(saver.Saver):
         self["subject"] = str(text_container["subject"]).format_map(params)
         self["text"] = str(text_container["text"]).format_map(params)
 
-    def send(self, recipients):
-        """Send the message to the given recipient email addresses.
+    def send(self, recipients, bcc=False):
+        """Queue the message for sending to the given recipient email addresses.
+        If 'bcc' is True, the recipients are not shown to each other.
         Raises ValueError if some other error.
         """
         if not recipients:
@@ -82,21 +261,18 @@ class MessageSaver(saver.Saver):
             raise ValueError("No text body specified.")
         if isinstance(recipients, str):
             recipients = [recipients]
-        try:
-            self["recipients"] = recipients
-            message = email.message.EmailMessage()
-            message["From"] = self["sender"]
-            message["Subject"] = self["subject"]
-            if self["reply-to"]:
-                message["Reply-To"] = self["reply-to"]
-            message["To"] = ", ".join(set(self["recipients"]))
-            message.set_content(self["text"])
-            self.server.send_message(message)
-            self["sent"] = utils.timestamp()
-        except smtplib.SMTPException as error:
-            self.handle_error(error)
+        if bcc:
+            self["recipients"] = []
+            self["bcc"] = recipients
         else:
-            self.handler.set_message_flash("Email message(s) sent.")
+            self["recipients"] = recipients
+        self["status"] = constants.QUEUED
+        self["attempts"] = 0
+        self["next_attempt"] = utils.timestamp()
+        try:
+            self.handler.set_message_flash("Email message(s) queued for sending.")
+        except AttributeError:  # If handler is None.
+            pass
 
     def handle_error(self, error):
         "Convert into a nicer error message to display."
@@ -111,11 +287,212 @@ class MessageSaver(saver.Saver):
         )
 
     def post_process(self):
-        try:
-            self.server.quit()
-        except (smtplib.SMTPException, AttributeError):
-            pass
+        "Start delivery of the queued message."
+        if self.get("status") == constants.QUEUED:
+            notify_delivery()
 
     def log(self):
         "Do not create any log entry; the message is its own log."
         pass
+
+    def get_log_entry(self):
+        "No log entry; the message is its own log."
+        return None
+
+
+def queue_mailing(handler, text_container, recipients, mailing):
+    """Queue the message for the recipients in batches, using one bulk request.
+    Each batch is one message with its recipients hidden from each other (Bcc),
+    or one message per recipient if MAIL_BCC_BATCH_SIZE is 0. The batches
+    are scheduled MAIL_BATCH_INTERVAL seconds apart to limit the sending rate.
+    The messages are marked by the mailing identifier, for progress reports.
+    Raises ValueError if the email server is not configured.
+    Return the number of messages queued.
+    """
+    size = settings["MAIL_BCC_BATCH_SIZE"]
+    recipients = sorted(set(recipients))
+    if size:
+        batches = [recipients[i : i + size] for i in range(0, len(recipients), size)]
+    else:
+        batches = [[r] for r in recipients]
+    savers = []
+    for number, batch in enumerate(batches):
+        message_saver = MessageSaver(handler=handler)
+        message_saver.create(text_container)
+        message_saver.send(batch, bcc=bool(size))
+        message_saver["mailing"] = mailing
+        message_saver["next_attempt"] = utils.timestamp(
+            days=number * settings["MAIL_BATCH_INTERVAL"] / 86400.0
+        )
+        savers.append(message_saver)
+    errors = [e for e in saver.save_bulk(handler.db, savers) if e]
+    if errors:
+        raise ValueError(f"Could not queue {len(errors)} messages: {errors[0]}")
+    return len(savers)
+
+
+def get_mailing_progress(db, mailing):
+    "Return a dictionary with the number of recipients per message status."
+    view = db.view(
+        "message",
+        "mailing",
+        startkey=[mailing],
+        endkey=[mailing, constants.CEILING],
+        reduce=True,
+        group=True,
+    )
+    return dict([(row.key[1], row.value) for row in view])
+
+
+def deliver_messages(db, limit=100):
+    """Send the queued messages that are due, using one connection to
+    the email server. A message is claimed by a process before sending it,
+    so that several processes may deliver from the same queue.
+    A failed message is retried with exponential backoff, until the
+    maximum number of attempts has been made.
+    Return the number of messages sent and failed.
+    """
+    view = db.view(
+        "message",
+        "queue",
+        endkey=utils.timestamp(),
+        limit=limit,
+        reduce=False,
+        include_docs=True,
+    )
+    sent = 0
+    failed = 0
+    logger = logging.getLogger("orderportal")
+    profile = orderportal.profiling.Profile()
+    token = profile.activate()
+    smtp_pool.close_idle()
+    try:
+        with MailSession() as session:
+            for row in view:
+                doc = row.doc
+                # A message still in status 'sending' when due has timed out;
+                # the process sending it must have stopped. Fail it if no
+                # attempts remain, otherwise reclaim it.
+                if (
+                    doc["status"] == constants.SENDING
+                    and doc.get("attempts", 0) >= settings["MAIL_MAX_ATTEMPTS"]
+                ):
+                    doc["status"] = constants.FAILED
+                    doc["error"] = "timed out while sending"
+                    doc.pop("next_attempt", None)
+                    doc["modified"] = utils.timestamp()
+                    logger.error(f"Email {doc['_id']} failed: timed out")
+                    save_message_status(db, doc)
+                    failed += 1
+                    continue
+                doc["status"] = constants.SENDING
+                doc["next_attempt"] = utils.timestamp(
+                    days=settings["MAIL_SENDING_TIMEOUT"] / 86400.0
+                )
+                # Count the attempt when claiming, in case the process stops.
+                doc["attempts"] = doc.get("attempts", 0) + 1
+                try:
+                    db.put(doc)
+                except couchdb2.RevisionError:  # Claimed by another process.
+                    continue
+                try:
+                    session.send(doc)
+                except (ValueError, TypeError, KeyError, OSError) as error:
+                    doc["error"] = str(error)
+                    if doc["attempts"] >= settings["MAIL_MAX_ATTEMPTS"]:
+                        doc["status"] = constants.FAILED
+                        doc.pop("next_attempt", None)
+                        logger.error(f"Email {doc['_id']} failed: {error}")
+                    else:
+                        doc["status"] = constants.QUEUED
+                        delay = settings["MAIL_RETRY_DELAY"] * 2 ** (
+                            doc["attempts"] - 1
+                        )
+                        doc["next_attempt"] = utils.timestamp(days=delay / 86400.0)
+                    failed += 1
+                else:
+                    doc["status"] = constants.SENT
+                    doc["sent"] = utils.timestamp()
+                    doc.pop("next_attempt", None)
+                    doc.pop("error", None)
+                    sent += 1
+                doc["modified"] = utils.timestamp()
+                save_message_status(db, doc)
+    finally:
+        orderportal.profiling.current.reset(token)
+    if sent or failed:
+        logger.info(
+            f"Email queue: {sent} sent, {failed} failed attempts;"
+            f" {profile.times['smtp']:.2f} s in email server calls."
+        )
+    return sent, failed
+
+
+def save_message_status(db, doc, attempts=5):
+    """Save the delivery status of the message. On revision conflict,
+    e.g. an edit of the message document, re-read it and reapply the status.
+    """
+    keys = ("status", "attempts", "error", "sent", "next_attempt", "modified")
+    for attempt in range(attempts):
+        try:
+            db.put(doc)
+            return
+        except couchdb2.RevisionError:
+            latest = db.get(doc["_id"])
+            if latest is None:
+                return
+            for key in keys:
+                if key in doc:
+                    latest[key] = doc[key]
+                else:
+                    latest.pop(key, None)
+            doc = latest
+    logging.getLogger("orderportal").error(
+        f"Could not save status '{doc['status']}' of email {doc['_id']}"
+    )
+
+
+def notify_delivery():
+    """Trigger the background delivery of queued messages, if running
+    within the web server. Otherwise do nothing; the messages will be
+    delivered by the periodic delivery of the web server.
+    """
+    loop = tornado.ioloop.IOLoop.current(instance=False)
+    if loop is None:
+        return
+    loop.add_callback(deliver_background)
+
+
+def start_delivery():
+    "Start the periodic background delivery of queued messages."
+    tornado.ioloop.PeriodicCallback(
+        deliver_background, settings["MAIL_QUEUE_INTERVAL"] * 1000
+    ).start()
+    notify_delivery()
+
+
+async def deliver_background():
+    """Deliver the queued messages in a background thread; own database
+    connection. Only one delivery at a time is run in this process;
+    a request made during delivery results in another round.
+    """
+    if _delivery["running"]:
+        _delivery["pending"] = True
+        return
+    _delivery["running"] = True
+    loop = tornado.ioloop.IOLoop.current()
+    try:
+        while True:
+            _delivery["pending"] = False
+            await loop.run_in_executor(None, deliver_background_batch)
+            if not _delivery["pending"]:
+                break
+    except Exception as error:
+        logging.getLogger("orderportal").error(f"Email delivery failed: {error}")
+    finally:
+        _delivery["running"] = False
+
+
+def deliver_background_batch():
+    "Deliver the queued messages that are due; own database connection."
+    return deliver_messages(orderportal.database.get_db())
@@ -0,0 +1,311 @@
+"""Aggregate metrics of the web server, output in Prometheus text format.
+Each process records its own metrics, and writes a snapshot of them to
+a file in the metrics directory at regular intervals. The metrics of all
+processes of the server are produced by summing the snapshots.
+"""
+
+import copy
+import json
+import logging
+import os
+import resource
+import socket
+import tempfile
+import threading
+import time
+
+import tornado.ioloop
+
+from orderportal import settings
+from orderportal import utils
+
+# Upper bounds (seconds) of the latency histogram buckets.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Snapshots not updated for this many intervals are from defunct processes.
+STALE_INTERVALS = 10
+
+
+def new_histogram():
+    "Return a new empty histogram; the last bucket count is for '+Inf'."
+    return dict(buckets=[0] * (len(BUCKETS) + 1), count=0, sum=0.0)
+
+
+def observe(histogram, seconds):
+    "Add the observation to the histogram."
+    for pos, bound in enumerate(BUCKETS):
+        if seconds <= bound:
+            break
+    else:
+        pos = len(BUCKETS)
+    histogram["buckets"][pos] += 1
+    histogram["count"] += 1
+    histogram["sum"] += seconds
+
+
+def add_histogram(histogram, other):
+    "Add the counts of the other histogram to the histogram."
+    for pos, value in enumerate(other["buckets"]):
+        histogram["buckets"][pos] += value
+    histogram["count"] += other["count"]
+    histogram["sum"] += other["sum"]
+
+
+def get_memory():
+    "Return the resident memory of this process in bytes."
+    try:
+        with open("/proc/self/statm") as infile:
+            return int(infile.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        # Peak rather than current, which is in kilobytes on Linux.
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Registry:
+    "The metrics recorded by this process."
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.handler_names = dict()  # Key: handler class.
+        self.requests = dict()  # Key: handler name.
+        self.db_calls = dict()  # Key: 'call design/view', or 'call'.
+        self.exports = dict()  # Key: handler name.
+
+    def set_handler_names(self, handlers):
+        "Set the lookup of handler names from the URL specifications."
+        for spec in handlers:
+            if spec.name:
+                self.handler_names.setdefault(spec.handler_class, spec.name)
+
+    def get_handler_name(self, handler):
+        "Return the name of the request handler."
+        try:
+            return self.handler_names[type(handler)]
+        except KeyError:
+            return type(handler).__name__
+
+    def observe_request(self, handler, seconds):
+        "Record the latency of the request."
+        name = self.get_handler_name(handler)
+        with self.lock:
+            try:
+                histogram = self.requests[name]
+            except KeyError:
+                histogram = self.requests[name] = new_histogram()
+            observe(histogram, seconds)
+
+    def observe_db(self, call, view, seconds):
+        "Record the latency of the database call; view, get or put."
+        key = f"{call} {view}" if view else call
+        with self.lock:
+            try:
+                histogram = self.db_calls[key]
+            except KeyError:
+                histogram = self.db_calls[key] = new_histogram()
+            observe(histogram, seconds)
+
+    def export_started(self, handler):
+        "Record the start of an export; CSV, XLSX or ZIP."
+        name = self.get_handler_name(handler)
+        with self.lock:
+            try:
+                counts = self.exports[name]
+            except KeyError:
+                counts = self.exports[name] = dict(running=0, total=0)
+            counts["running"] += 1
+            counts["total"] += 1
+
+    def export_finished(self, handler):
+        "Record the end of an export."
+        name = self.get_handler_name(handler)
+        with self.lock:
+            self.exports[name]["running"] -= 1
+
+    def get_snapshot(self):
+        "Return the metrics of this process as a JSON-serializable dictionary."
+        with self.lock:
+            result = copy.deepcopy(
+                dict(
+                    requests=self.requests,
+                    db_calls=self.db_calls,
+                    exports=self.exports,
+                )
+            )
+        result["host"] = socket.gethostname()
+        result["pid"] = os.getpid()
+        result["time"] = time.time()
+        result["memory"] = get_memory()
+        result["caches"] = dict(
+            markdown=utils.markdown_cache.get_stats(),
+            fragment=utils.fragment_cache.get_stats(),
+        )
+        return result
+
+
+registry = Registry()
+
+
+def get_dirpath():
+    "Return the path of the directory for the snapshot files of the processes."
+    return settings["METRICS_DIR"] or os.path.join(
+        tempfile.gettempdir(), f"orderportal_metrics_{settings['DATABASE_NAME']}"
+    )
+
+
+def get_filepath(dirpath):
+    "Return the path of the snapshot file of this process."
+    return os.path.join(dirpath, f"{socket.gethostname()}-{os.getpid()}.json")
+
+
+def write_snapshot():
+    "Write the snapshot of the metrics of this process to its file."
+    dirpath = get_dirpath()
+    filepath = get_filepath(dirpath)
+    try:
+        os.makedirs(dirpath, exist_ok=True)
+        with open(filepath + ".tmp", "w") as outfile:
+            json.dump(registry.get_snapshot(), outfile)
+        os.replace(filepath + ".tmp", filepath)
+    except OSError as error:
+        logging.getLogger("orderportal").error(f"Could not write metrics: {error}")
+
+
+def start_snapshots():
+    "Start writing the snapshots of the metrics of this process regularly."
+    tornado.ioloop.PeriodicCallback(
+        write_snapshot, settings["METRICS_INTERVAL"] * 1000
+    ).start()
+    write_snapshot()
+
+
+def get_snapshots():
+    """Return the snapshots of all processes. The current one for this
+    process, and the most recently written ones for the other processes.
+    The files of defunct processes are removed.
+    """
+    dirpath = get_dirpath()
+    own = get_filepath(dirpath)
+    result = [registry.get_snapshot()]
+    try:
+        filenames = os.listdir(dirpath)
+    except OSError:
+        return result
+    stale = time.time() - STALE_INTERVALS * settings["METRICS_INTERVAL"]
+    for filename in filenames:
+        filepath = os.path.join(dirpath, filename)
+        if filepath == own or not filename.endswith(".json"):
+            continue
+        try:
+            if os.path.getmtime(filepath) < stale:
+                os.remove(filepath)
+                continue
+            with open(filepath) as infile:
+                result.append(json.load(infile))
+        except (OSError, ValueError):
+            pass
+    return result
+
+
+def merge(snapshots, key):
+    "Return the histograms or counts for the key summed over the snapshots."
+    result = dict()
+    for snapshot in snapshots:
+        for name, value in snapshot.get(key, {}).items():
+            if "buckets" in value:
+                add_histogram(result.setdefault(name, new_histogram()), value)
+            else:
+                total = result.setdefault(name, dict())
+                for item, count in value.items():
+                    total[item] = total.get(item, 0) + count
+    return result
+
+
+def escape(value):
+    "Return the value escaped for use as a label value."
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def get_text(db):
+    "Return the metrics for all processes in Prometheus text format."
+    snapshots = get_snapshots()
+    lines = []
+
+    def header(name, type, help):
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} {type}")
+
+    def histograms(name, data, labels):
+        for key in sorted(data):
+            histogram = data[key]
+            label = labels(key)
+            cumulative = 0
+            for bound, count in zip(BUCKETS + ("+Inf",), histogram["buckets"]):
+                cumulative += count
+                lines.append(f'{name}_bucket{{{label},le="{bound}"}} {cumulative}')
+            lines.append(f"{name}_sum{{{label}}} {histogram['sum']:.6f}")
+            lines.append(f"{name}_count{{{label}}} {histogram['count']}")
+
+    name = "orderportal_request_duration_seconds"
+    header(name, "histogram", "Request latency by handler.")
+    histograms(name, merge(snapshots, "requests"), lambda k: f'handler="{escape(k)}"')
+
+    name = "orderportal_couchdb_duration_seconds"
+    header(name, "histogram", "CouchDB call latency by call and design/view.")
+
+    def labels(key):
+        call, _, view = key.partition(" ")
+        return f'call="{escape(call)}",view="{escape(view)}"'
+
+    histograms(name, merge(snapshots, "db_calls"), labels)
+
+    caches = merge(snapshots, "caches")
+    for item, type, help in [
+        ("hits", "counter", "Cache lookups found."),
+        ("misses", "counter", "Cache lookups not found."),
+        ("evictions", "counter", "Cache entries evicted."),
+        ("size", "gauge", "Cache entries."),
+    ]:
+        name = f"orderportal_cache_{item}"
+        if type == "counter":
+            name += "_total"
+        header(name, type, help)
+        for cache, stats in sorted(caches.items()):
+            lines.append(f'{name}{{cache="{escape(cache)}"}} {stats[item]}')
+    name = "orderportal_cache_hit_ratio"
+    header(name, "gauge", "Fraction of cache lookups found.")
+    for cache, stats in sorted(caches.items()):
+        lookups = stats["hits"] + stats["misses"]
+        ratio = lookups and stats["hits"] / lookups or 0.0
+        lines.append(f'{name}{{cache="{escape(cache)}"}} {ratio:.4f}')
+
+    name = "orderportal_email_queue_depth"
+    header(name, "gauge", "Email messages queued or being sent.")
+    view = db.view("message", "queue", reduce=True)
+    try:
+        depth = list(view)[0].value
+    except IndexError:
+        depth = 0
+    lines.append(f"{name} {depth}")
+
+    exports = merge(snapshots, "exports")
+    name = "orderportal_exports_running"
+    header(name, "gauge", "Exports in progress by handler.")
+    for handler, counts in sorted(exports.items()):
+        lines.append(f'{name}{{handler="{escape(handler)}"}} {counts["running"]}')
+    name = "orderportal_exports_total"
+    header(name, "counter", "Exports started by handler.")
+    for handler, counts in sorted(exports.items()):
+        lines.append(f'{name}{{handler="{escape(handler)}"}} {counts["total"]}')
+
+    name = "orderportal_process_resident_memory_bytes"
+    header(name, "gauge", "Resident memory by process.")
+    for snapshot in snapshots:
+        host = escape(snapshot["host"])
+        label = f'host="{host}",pid="{snapshot["pid"]}"'
+        lines.append(f"{name}{{{label}}} {snapshot['memory']}")
+    name = "orderportal_processes"
+    header(name, "gauge", "Server processes reporting metrics.")
+    lines.append(f"{name} {len(snapshots)}")
+
+    lines.append("")
+    return "\n".join(lines)
@@ -1,11 +1,12 @@
 "Orders are the whole point of this app. The user fills in info for facility."
 
+import base64
+import binascii
 import io
 import json
 import os.path
 import re
 import traceback
-import urllib.parse
 import zipfile
 
 import tornado.web
@@ -15,9 +16,62 @@ from orderportal import settings
 from orderportal import saver
 from orderportal import utils
 from orderportal.admin import MetaSaver
-from orderportal.fields import Fields
+from orderportal.fields import get_compiled_fields
 from orderportal.message import MessageSaver
 from orderportal.requesthandler import RequestHandler, ApiV1Mixin
+import orderportal.database
+
+
+# Block of order identifier numbers reserved by this process.
+_order_numbers = dict(next=None, last=None)
+
+
+def allocate_order_number(db):
+    """Return the next order identifier number for this process.
+    Numbers are reserved in blocks of size ORDER_IDENTIFIER_BLOCK by
+    advancing the counter in the meta document 'order'. Each block is
+    used by only one process, so the identifiers remain unique.
+    Numbers in a block not used before the process stops are skipped,
+    so any gap is at most one block minus one per process restart.
+    """
+    if (
+        _order_numbers["next"] is None
+        or _order_numbers["next"] > _order_numbers["last"]
+    ):
+        _reserve_order_numbers(db)
+    number = _order_numbers["next"]
+    _order_numbers["next"] += 1
+    return number
+
+
+class OrderCounterSaver(MetaSaver):
+    "Saver for the order identifier counter; never merge on revision conflict."
+
+    conflict_retries = 0
+
+
+def _reserve_order_numbers(db, attempts=10):
+    """Reserve the next block of order identifier numbers.
+    Retry from a re-read counter if another process reserved a block
+    at the same time; any revision conflict means that it did.
+    """
+    size = max(1, settings["ORDER_IDENTIFIER_BLOCK"])
+    for attempt in range(attempts):
+        doc = db["order"]
+        try:
+            first = doc["counter"] + 1
+        except KeyError:
+            first = settings["ORDER_IDENTIFIER_FIRST"]
+        last = first + size - 1
+        try:
+            with OrderCounterSaver(doc, db=db) as saver:
+                saver["counter"] = last
+        except IOError:
+            continue
+        _order_numbers["next"] = first
+        _order_numbers["last"] = last
+        return
+    raise IOError("could not reserve order identifier numbers")
 
 
 class OrderSaver(saver.Saver):
@@ -37,28 +91,30 @@ class OrderSaver(saver.Saver):
         self.files = []
         self.filenames = set(self.get("_attachments", []))
         try:
-            self.fields = Fields(self.handler.get_form(self["form"]))
+            self.form = self.handler.get_form(self["form"])
+            self.fields = get_compiled_fields(self.form)
         except KeyError:
             pass
 
-    def create(self, form, title=None):
-        "Create the order from the given form."
-        self.fields = Fields(form)
+    def create(self, form, title=None, identifier=True):
+        """Create the order from the given form.
+        Set the order identifier, unless to be done later by 'set_identifier'.
+        """
+        self.form = form
+        self.fields = get_compiled_fields(form)
         self["form"] = form["_id"]
         self["title"] = title
         self["fields"] = dict([(f["identifier"], None) for f in self.fields])
         # Since version 9.1.0, the status PREPARATION is hard-wired as the initial one.
         self.set_status(constants.PREPARATION)
-        # Set the order identifier if its format defined.
+        if identifier:
+            self.set_identifier()
+
+    def set_identifier(self):
+        "Set the order identifier; allocates the next number."
         # Allow also for disabled, since admin may clone such orders.
-        if form["status"] in (constants.ENABLED, constants.DISABLED):
-            doc = self.db["order"]
-            with MetaSaver(doc, self) as saver:
-                try:
-                    number = doc["counter"] + 1
-                except KeyError:
-                    number = settings["ORDER_IDENTIFIER_FIRST"]
-                saver["counter"] = number
+        if self.form["status"] in (constants.ENABLED, constants.DISABLED):
+            number = allocate_order_number(self.db)
             self["identifier"] = settings["ORDER_IDENTIFIER_FORMAT"].format(number)
 
     def autopopulate(self):
@@ -134,7 +190,7 @@ class OrderSaver(saver.Saver):
                     )
                 )
         self["status"] = new
-        self.doc["history"][new] = utils.today()
+        self["history"][new] = utils.today()
 
     def set_tags(self, tags):
         """Set the tags of the order from JSON data (list of strings).
@@ -241,7 +297,7 @@ class OrderSaver(saver.Saver):
                     value = self.handler.get_arguments(identifier)
 
             elif field["type"] == constants.TABLE:
-                coldefs = [utils.parse_field_table_column(c) for c in field["table"]]
+                coldefs = self.fields.coldefs[identifier]
                 if data:  # JSON data: contains the complete table.
                     try:
                         table = data[identifier]
@@ -338,106 +394,27 @@ class OrderSaver(saver.Saver):
                 changed = self.changed.setdefault("fields", dict())
                 changed[identifier] = value
                 self["fields"][identifier] = value
-        self.check_fields_validity()
+        self.check_fields_validity(self.changed.get("fields", dict()).keys())
 
-    def check_fields_validity(self):
-        "Check validity of current field values."
-        self["invalid"] = dict()
-        for field in self.fields:
-            if field["depth"] == 0:
-                self.check_validity(field)
-
-    def check_validity(self, field):
-        """Check validity of field value.
-        Also convert the value for some field types.
-        Skip field if not visible, else check recursively in postorder.
-        Return True if valid, False otherwise.
+    def check_fields_validity(self, identifiers=None):
+        """Check validity of current field values.
+        If the identifiers of the changed fields are given, then check only
+        the fields affected by those. Otherwise check all fields, as also
+        when the form has changed since the previous check.
         """
-        try:
-            select_id = field.get("visible_if_field")
-            if select_id:
-                select_value = self["fields"].get(select_id)
-                if select_value is not None:
-                    select_value = str(select_value).lower()
-                if_value = field.get("visible_if_value")
-                if if_value:
-                    if_value = if_value.lower()
-                if select_value != if_value:
-                    return True
-
-            if field["type"] == constants.GROUP:
-                failure = False
-                for subfield in field["fields"]:
-                    if not self.check_validity(subfield):
-                        failure = True
-                if failure:
-                    raise ValueError("subfield(s) invalid")
-            else:
-                value = self["fields"][field["identifier"]]
-                if value is None:
-                    if field["required"]:
-                        raise ValueError("missing value")
-                elif field["type"] == constants.STRING:
-                    pass
-                elif field["type"] == constants.EMAIL:
-                    if not constants.EMAIL_RX.match(value):
-                        raise ValueError("not a valid email address")
-                elif field["type"] == constants.INT:
-                    try:
-                        self["fields"][field["identifier"]] = int(value)
-                    except (TypeError, ValueError):
-                        raise ValueError("not an integer value")
-                elif field["type"] == constants.FLOAT:
-                    try:
-                        self["fields"][field["identifier"]] = float(value)
-                    except (TypeError, ValueError):
-                        raise ValueError("not a float value")
-                elif field["type"] == constants.BOOLEAN:
-                    try:
-                        if value is None:
-                            raise ValueError
-                        self["fields"][field["identifier"]] = utils.to_bool(value)
-                    except (TypeError, ValueError):
-                        raise ValueError("not a boolean value")
-                elif field["type"] == constants.URL:
-                    parsed = urllib.parse.urlparse(value)
-                    if not (parsed.scheme and parsed.netloc):
-                        raise ValueError("incomplete URL")
-                elif field["type"] == constants.SELECT:
-                    if value not in field["select"]:
-                        raise ValueError("value not among alternatives")
-                elif field["type"] == constants.MULTISELECT:
-                    if not isinstance(value, list):
-                        raise ValueError("value is not a list")
-                    if field["required"] and len(value) == 1 and value[0] == "":
-                        raise ValueError("missing value")
-                    for v in value:
-                        if v and v not in field["multiselect"]:
-                            raise ValueError("value not among alternatives")
-                elif field["type"] == constants.TEXT:
-                    if not isinstance(value, str):
-                        raise ValueError("value is not a text string")
-                elif field["type"] == constants.DATE:
-                    if not constants.DATE_RX.match(value):
-                        raise ValueError("value is not a valid date")
-                elif field["type"] == constants.TABLE:
-                    if not isinstance(value, list):
-                        raise ValueError("table value is not a list")
-                    if field["required"] and len(value) == 0:
-                        raise ValueError("missing data")
-                    for r in value:
-                        if not isinstance(r, list):
-                            raise ValueError("table value is not a list of lists")
-                elif field["type"] == constants.FILE:
-                    pass
-        except ValueError as error:
-            self["invalid"][field["identifier"]] = str(error)
-            return False
-        except Exception as error:
-            self["invalid"][field["identifier"]] = f"System error: {error}"
-            return False
+        form_rev = self.form.get("_rev")
+        if (
+            not identifiers
+            or "invalid" not in self.doc
+            or self.get("invalid_form_rev") != form_rev
+        ):
+            invalid = dict()
+            identifiers = None
         else:
-            return True
+            invalid = dict(self["invalid"])
+        self.fields.check_validity(self["fields"], invalid, identifiers=identifiers)
+        self["invalid"] = invalid
+        self["invalid_form_rev"] = form_rev
 
     def set_history(self, history):
         "Set the history the JSON data (dict of status->date)"
@@ -500,19 +477,13 @@ class OrderSaver(saver.Saver):
             # Send to members in owner's group, if so set for this status change.
             if constants.GROUP in message_template["recipients"]:
                 colleagues = dict()
-                for row in self.db.view(
-                    "group",
-                    "member",
-                    include_docs=True,
-                    key=owner["email"].strip().lower(),
-                ):
-                    for member in row.doc["members"]:
-                        try:
-                            account = self.handler.get_account(member)
-                            if account["status"] == constants.ENABLED:
-                                colleagues[account["email"]] = account
-                        except ValueError:
-                            pass
+                for member in self.handler.get_account_colleagues(owner["email"]):
+                    try:
+                        account = self.handler.get_account(member)
+                        if account["status"] == constants.ENABLED:
+                            colleagues[account["email"]] = account
+                    except ValueError:
+                        pass
                 for colleague in colleagues.values():
                     if not colleague.get("no_order_messages"):
                         recipients.add(colleague["email"])
@@ -614,29 +585,30 @@ class OrderMixin:
                 f"{term} creation is not allowed for account with role 'user'."
             )
 
-    def get_fields(self, order, depth=0, fields=None):
+    def get_fields(self, order):
         """Return a list of dictionaries, each of which
         for a field that is visible to the current user."""
-        if fields is None:
-            form = self.get_form(order["form"])
-            fields = form["fields"]
+        fields = get_compiled_fields(self.get_form(order["form"]))
+        am_staff = self.am_staff()
         result = []
+        skip_depth = None  # Skip the subfields of a hidden group field.
         for field in fields:
+            if skip_depth is not None:
+                if field["depth"] > skip_depth:
+                    continue
+                skip_depth = None
             # Check if field may not be viewed by the current user.
-            if field["restrict_read"] and not self.am_staff():
-                continue
             # Is there a visibility condition? If so, check it.
-            fid = field.get("visible_if_field")
-            if fid:
-                value = str(order["fields"].get(fid)).lower()
-                opt = str(field.get("visible_if_value")).lower().split("|")
-                if value not in opt:
-                    continue
+            if (field["restrict_read"] and not am_staff) or not fields.is_visible(
+                field["identifier"], order["fields"]
+            ):
+                skip_depth = field["depth"]
+                continue
             item = dict(identifier=field["identifier"])
             item["label"] = field.get("label") or field[
                 "identifier"
             ].capitalize().replace("_", " ")
-            item["depth"] = depth
+            item["depth"] = field["depth"]
             item["type"] = field["type"]
             item["value"] = order["fields"].get(field["identifier"])
             item["restrict_read"] = field["restrict_read"]
@@ -645,8 +617,6 @@ class OrderMixin:
             item["description"] = field.get("description")
             item["__field__"] = field
             result.append(item)
-            if field["type"] == constants.GROUP:
-                result.extend(self.get_fields(order, depth + 1, field["fields"]))
         return result
 
     def get_targets(self, order):
@@ -688,106 +658,149 @@ class OrderMixin:
 
     def get_reports(self, order):
         "Get the report entities. All for staff, only published for ordinary user."
-        if self.am_staff():
-            result = [
-                r.doc
-                for r in self.db.view(
-                    "report", "order", key=order["_id"], include_docs=True
-                )
-            ]
-        else:
-            result = [
-                r.doc
-                for r in self.db.view(
-                    "report", "order", key=order["_id"], include_docs=True
-                )
-                if r.doc["status"] == constants.PUBLISHED
-            ]
-        result.sort(key=lambda r: r["modified"], reverse=True)
+        return self.get_reports_lookup([order])[order["_id"]]
+
+    def get_reports_lookup(self, orders):
+        """Get the report entities for the given orders in one query.
+        Return a dictionary with order IUID as key and the list of reports,
+        most recent first, as value. All for staff, only published for
+        ordinary user.
+        """
+        result = dict([(order["_id"], []) for order in orders])
+        if not result:
+            return result
+        am_staff = self.am_staff()
+        rows = orderportal.database.get_view_rows(
+            self.db, "report", "order", list(result), include_docs=True
+        )
+        for row in rows:
+            if am_staff or row.doc["status"] == constants.PUBLISHED:
+                result[row.key].append(row.doc)
+        for reports in result.values():
+            reports.sort(key=lambda r: r["modified"], reverse=True)
         return result
 
 
 class OrderApiV1Mixin(OrderMixin, ApiV1Mixin):
     "Mixin for order JSON data structure."
 
-    def get_order_json(self, order, full=False):
+    def get_includes(self):
+        "Return the set of optional items given by the 'include' argument."
+        return set(
+            [s.strip() for s in self.get_argument("include", "").split(",") if s.strip()]
+        )
+
+    def get_projection(self):
+        """Return the set of items given by the 'fields' argument, or None.
+        The value for a single order field is specified as 'fields.{identifier}'.
+        """
+        projection = set(
+            [s.strip() for s in self.get_argument("fields", "").split(",") if s.strip()]
+        )
+        if not projection:
+            return None
+        # A single order field implies the 'fields' item.
+        if [s for s in projection if s.startswith("fields.")]:
+            projection.add("fields")
+        return projection
+
+    def get_order_json(self, order, full=False, reports=None, projection=None):
         """Return a dictionary for JSON output for the order.
         If 'full' then add all fields, else only for orders list.
+        The reports are included if 'full', or if given explicitly.
+        If 'projection' is given, then only those items are included,
+        and the work for any other items is skipped. The IUID is always included.
         NOTE: Only the values of the fields are included, not
         the full definition of the fields. To obtain that,
         one must fetch the JSON for the corresponding form.
         """
         URL = self.absolute_reverse_url
+
+        def wanted(key):
+            return projection is None or key in projection
+
         if full:
             data = utils.get_json(self.order_reverse_url(order, api=True), "order")
         else:
             data = dict()
-        data["identifier"] = order.get("identifier")
-        data["title"] = order.get("title") or "[no title]"
+        if wanted("identifier"):
+            data["identifier"] = order.get("identifier")
+        if wanted("title"):
+            data["title"] = order.get("title") or "[no title]"
         data["iuid"] = order["_id"]
-        if full:
+        if wanted("form"):
             form = self.lookup_form(order["form"])
-            data["form"] = dict(
-                [
-                    ("title", form["title"]),
-                    ("version", form.get("version")),
-                    ("iuid", form["_id"]),
-                    (
-                        "links",
-                        dict(
-                            api=dict(href=URL("form_api", form["_id"])),
-                            display=dict(href=URL("form", form["_id"])),
+            if full:
+                data["form"] = dict(
+                    [
+                        ("title", form["title"]),
+                        ("version", form.get("version")),
+                        ("iuid", form["_id"]),
+                        (
+                            "links",
+                            dict(
+                                api=dict(href=URL("form_api", form["_id"])),
+                                display=dict(href=URL("form", form["_id"])),
+                            ),
                         ),
-                    ),
-                ]
-            )
-        else:
-            form = self.lookup_form(order["form"])
-            data["form"] = dict(
-                iuid=order["form"],
-                title=form["title"],
-                version=form.get("version"),
-                links=dict(api=dict(href=URL("form", order["form"]))),
-            )
-        data["owner"] = dict(
-            email=order["owner"],
-            name=self.lookup_account_name(order["owner"]),
-            links=dict(
-                api=dict(href=URL("account_api", order["owner"])),
-                display=dict(href=URL("account", order["owner"])),
-            ),
-        )
-        data["status"] = order["status"]
-        data["reports"] = [
-            dict(
-                iuid=report["_id"],
-                name=report["name"],
-                filename=list(report["_attachments"].keys())[0],
-                status=report["status"],
-                modified=report["modified"],
+                    ]
+                )
+            else:
+                data["form"] = dict(
+                    iuid=order["form"],
+                    title=form["title"],
+                    version=form.get("version"),
+                    links=dict(api=dict(href=URL("form", order["form"]))),
+                )
+        if wanted("owner"):
+            data["owner"] = dict(
+                email=order["owner"],
+                name=self.lookup_account_name(order["owner"]),
                 links=dict(
-                    api=dict(
-                        href=self.absolute_reverse_url("report_api", report["_id"])
-                    ),
-                    file=dict(href=self.absolute_reverse_url("report", report["_id"])),
+                    api=dict(href=URL("account_api", order["owner"])),
+                    display=dict(href=URL("account", order["owner"])),
                 ),
             )
-            for report in self.get_reports(order)
-        ]
-        data["history"] = dict()
-        for s in settings["ORDER_STATUSES"]:
-            if not s.get("enabled"):
-                continue
-            key = s["identifier"]
-            data["history"][key] = order["history"].get(key)
-        data["tags"] = order.get("tags", [])
-        data["modified"] = order["modified"]
-        data["created"] = order["created"]
-        data["links"] = dict(
-            api=dict(href=self.order_reverse_url(order, api=True)),
-            display=dict(href=self.order_reverse_url(order)),
-        )
-        if full:
+        if wanted("status"):
+            data["status"] = order["status"]
+        if full and reports is None and wanted("reports"):
+            reports = self.get_reports(order)
+        if reports is not None and wanted("reports"):
+            data["reports"] = [
+                dict(
+                    iuid=report["_id"],
+                    name=report["name"],
+                    filename=list(report["_attachments"].keys())[0],
+                    status=report["status"],
+                    modified=report["modified"],
+                    links=dict(
+                        api=dict(href=URL("report_api", report["_id"])),
+                        file=dict(href=URL("report", report["_id"])),
+                    ),
+                )
+                for report in reports
+            ]
+        if wanted("history"):
+            data["history"] = dict()
+            for s in settings["ORDER_STATUSES"]:
+                if not s.get("enabled"):
+                    continue
+                key = s["identifier"]
+                data["history"][key] = order["history"].get(key)
+        if wanted("tags"):
+            data["tags"] = order.get("tags", [])
+        if wanted("modified"):
+            data["modified"] = order["modified"]
+        if wanted("created"):
+            data["created"] = order["created"]
+        if wanted("links"):
+            data["links"] = dict(
+                api=dict(href=self.order_reverse_url(order, api=True)),
+                display=dict(href=self.order_reverse_url(order)),
+            )
+        if not full:
+            return data
+        if wanted("links"):
             for status in self.get_targets(order):
                 data["links"][status["identifier"]] = dict(
                     href=URL(
@@ -796,11 +809,16 @@ class OrderApiV1Mixin(OrderMixin, ApiV1Mixin):
                     name="transition",
                 )
             data["links"]["external"] = order.get("links", {}).get("external", [])
+        if wanted("fields"):
+            identifiers = self.get_projection_fields(projection)
             data["fields"] = dict()
             # A bit roundabout, but the fields will come out in correct order
             for field in self.get_fields(order):
-                data["fields"][field["identifier"]] = field["value"]
+                if identifiers is None or field["identifier"] in identifiers:
+                    data["fields"][field["identifier"]] = field["value"]
+        if wanted("invalid"):
             data["invalid"] = order.get("invalid", {})
+        if wanted("files"):
             data["files"] = dict()
             for filename in sorted(order.get("_attachments", [])):
                 # if filename.startswith(constants.SYSTEM):
@@ -809,13 +827,18 @@ class OrderApiV1Mixin(OrderMixin, ApiV1Mixin):
                 data["files"][filename] = dict(
                     size=stub["length"],
                     content_type=stub["content_type"],
-                    href=self.absolute_reverse_url(
-                        "order_file", order["_id"], filename
-                    ),
+                    href=URL("order_file", order["_id"], filename),
                 )
-        # Terrible kludge! Converts binary keys and values to string.
-        # A Python3 issue, possible due to bad old CouchDB interface.
-        return json.loads(json.dumps(data))
+        return data
+
+    def get_projection_fields(self, projection):
+        """Return the set of order field identifiers given in the projection,
+        or None if all fields are to be included.
+        """
+        if projection is None:
+            return None
+        identifiers = set([s[7:] for s in projection if s.startswith("fields.")])
+        return identifiers or None
 
 
 class OrderCreate(OrderMixin, RequestHandler):
@@ -862,7 +885,7 @@ class OrderCreateApiV1(OrderApiV1Mixin, OrderMixin, RequestHandler):
                 saver.check_fields_validity()
         except ValueError as error:
             raise tornado.web.HTTPError(400, reason=str(error))
-        self.write(self.get_order_json(saver.doc, full=True))
+        self.write_json(self.get_order_json(saver.doc, full=True))
 
 
 class Order(OrderMixin, RequestHandler):
@@ -926,7 +949,7 @@ class Order(OrderMixin, RequestHandler):
             self.see_other("order", order["_id"], error=error)
             return
         self.delete_logs(order["_id"])
-        self.db.delete(order)
+        orderportal.database.delete_order(self.db, order)
         self.see_other("orders")
 
 
@@ -939,7 +962,22 @@ class OrderApiV1(OrderApiV1Mixin, OrderMixin, RequestHandler):
             self.check_readable(order)
         except ValueError as error:
             raise tornado.web.HTTPError(403, reason=str(error))
-        self.write(self.get_order_json(order, full=True))
+        projection = self.get_projection()
+        # The form from the catalogue; the reports only if to be output.
+        form = self.lookup_form(order["form"]) or self.get_form(order["form"])
+        docs = [order, form]
+        if projection is None or "reports" in projection:
+            reports = self.get_reports(order)
+            docs.extend(reports)
+        else:
+            reports = None
+        if self.check_not_modified(docs):
+            return
+        self.write_json(
+            self.get_order_json(
+                order, full=True, reports=reports, projection=projection
+            )
+        )
 
     def post(self, iuid):
         order = self.get_order(iuid)
@@ -977,12 +1015,14 @@ class OrderApiV1(OrderApiV1Mixin, OrderMixin, RequestHandler):
                         pass
         except ValueError as error:
             raise tornado.web.HTTPError(400, reason=str(error))
-        self.write(self.get_order_json(order, full=True))
+        self.write_json(self.get_order_json(order, full=True))
 
 
 class OrderCsv(OrderMixin, RequestHandler):
     "Return a CSV file containing the order data. Contains field definitions."
 
+    export = True
+
     @tornado.web.authenticated
     def get(self, iuid):
         order = self.get_order(iuid)
@@ -1164,7 +1204,7 @@ class OrderEdit(OrderMixin, RequestHandler):
             return
         colleagues = sorted(self.get_account_colleagues(self.current_user["email"]))
         form = self.get_form(order["form"])
-        fields = Fields(form)
+        fields = get_compiled_fields(form)
         if self.am_staff():
             tags = order.get("tags", [])
         else:
@@ -1343,7 +1383,333 @@ class OrderTransitionApiV1(OrderApiV1Mixin, OrderMixin, RequestHandler):
                 saver.set_status(targetid)
         except ValueError as error:
             raise tornado.web.HTTPError(403, reason=str(error))
-        self.write(self.get_order_json(order, full=True))
+        self.write_json(self.get_order_json(order, full=True))
+
+
+class OrdersTransitionMixin:
+    """Change the status of several orders in one operation.
+    The orders are saved using one bulk request to the database, and
+    the queued messages are sent by the delivery worker using one
+    connection to the email server.
+    The account lookups for the message recipients are cached.
+    """
+
+    def transition_orders(self, identifiers, targetid):
+        """Change the status of the orders given by identifier or IUID.
+        Return a list of items with the outcome for each order.
+        """
+        savers = dict()  # Key: order IUID.
+        items = []
+        for identifier in identifiers:
+            item = dict(order=identifier)
+            items.append(item)
+            try:
+                order = self.get_order(str(identifier))
+                item["iuid"] = order["_id"]
+                if order["_id"] in savers:
+                    continue
+                for target in self.get_targets(order):
+                    if target["identifier"] == targetid:
+                        break
+                else:
+                    raise ValueError("disallowed status transition")
+                order_saver = OrderSaver(doc=order, handler=self)
+                order_saver.set_status(targetid)
+                savers[order["_id"]] = order_saver
+            except ValueError as error:
+                item["error"] = str(error)
+            except tornado.web.HTTPError as error:
+                item["error"] = error.reason or error.log_message or str(error)
+        errors = dict(
+            zip(savers.keys(), saver.save_bulk(self.db, list(savers.values())))
+        )
+        for item in items:
+            if "error" in item:
+                item["ok"] = False
+            elif errors[item["iuid"]]:
+                item["ok"] = False
+                item["error"] = errors[item["iuid"]]
+            else:
+                item["ok"] = True
+                item["doc"] = savers[item["iuid"]].doc
+        return items
+
+    def get_account(self, email, password=None):
+        "Get the account; cached unless password is to be checked."
+        if password:
+            return super().get_account(email, password=password)
+        email = email.strip().lower()
+        try:
+            accounts = self._cache_accounts
+        except AttributeError:
+            accounts = self._cache_accounts = dict()
+        try:
+            account = accounts[email]
+        except KeyError:
+            try:
+                account = accounts[email] = super().get_account(email)
+            except ValueError as error:
+                account = accounts[email] = error
+        if isinstance(account, ValueError):
+            raise account
+        return account
+
+    def get_account_colleagues(self, email):
+        "Get the set of emails for colleagues of the account; cached."
+        try:
+            colleagues = self._cache_colleagues
+        except AttributeError:
+            colleagues = self._cache_colleagues = dict()
+        email = email.strip().lower()
+        try:
+            return colleagues[email]
+        except KeyError:
+            result = colleagues[email] = super().get_account_colleagues(email)
+            return result
+
+    def get_admins(self):
+        "Get the list of enabled admin accounts; cached."
+        try:
+            return self._cache_admins
+        except AttributeError:
+            self._cache_admins = super().get_admins()
+            return self._cache_admins
+
+    def get_staff(self):
+        "Get the list of enabled staff accounts; cached."
+        try:
+            return self._cache_staff
+        except AttributeError:
+            self._cache_staff = super().get_staff()
+            return self._cache_staff
+
+
+class OrdersTransition(OrdersTransitionMixin, OrderMixin, RequestHandler):
+    "Change the status of the selected orders in the orders list."
+
+    @tornado.web.authenticated
+    def post(self):
+        self.check_staff()
+        targetid = self.get_argument("status", None)
+        identifiers = self.get_arguments("order")
+        if not targetid:
+            self.see_other("orders", error="No status selected.")
+            return
+        if not identifiers:
+            self.see_other(
+                "orders", error=f"No {utils.terminology('orders')} selected."
+            )
+            return
+        if len(identifiers) > constants.BULK_LIMIT:
+            self.see_other(
+                "orders",
+                error=f"More than {constants.BULK_LIMIT} {utils.terminology('orders')}"
+                " selected.",
+            )
+            return
+        items = self.transition_orders(identifiers, targetid)
+        n_ok = len([i for i in items if i["ok"]])
+        failed = [i for i in items if not i["ok"]]
+        if n_ok:
+            self.set_message_flash(
+                f"Changed status of {n_ok} {utils.terminology('orders')} to {targetid}."
+            )
+        if failed:
+            self.set_error_flash(
+                "Could not change status of "
+                + "; ".join([f"{i['order']}: {i['error']}" for i in failed])
+            )
+        self.see_other("orders", status=targetid)
+
+
+class OrdersTransitionApiV1(
+    OrdersTransitionMixin, OrderApiV1Mixin, OrderMixin, RequestHandler
+):
+    """Change the status of several orders by an API call.
+    The JSON body must contain 'orders', a list of order identifiers or IUIDs,
+    and 'status', the identifier of the new status.
+    """
+
+    def post(self):
+        try:
+            self.check_login()
+        except ValueError as error:
+            raise tornado.web.HTTPError(403, reason=str(error))
+        try:
+            data = self.get_json_body()
+            identifiers = data["orders"]
+            if not isinstance(identifiers, list):
+                raise ValueError("'orders' is not a list")
+            if len(identifiers) > constants.BULK_LIMIT:
+                raise ValueError(f"more than {constants.BULK_LIMIT} orders")
+            targetid = data["status"]
+            if not isinstance(targetid, str):
+                raise ValueError("'status' is not a string")
+        except (KeyError, TypeError, ValueError) as error:
+            raise tornado.web.HTTPError(400, reason=f"invalid data: {error}")
+        items = self.transition_orders(identifiers, targetid)
+        for item in items:
+            order = item.pop("doc", None)
+            if order is not None:
+                item["identifier"] = order.get("identifier")
+                item["status"] = order["status"]
+                item["links"] = dict(
+                    api=dict(href=self.order_reverse_url(order, api=True)),
+                    display=dict(href=self.order_reverse_url(order)),
+                )
+        data = utils.get_json(
+            self.absolute_reverse_url("orders_transition_api"), "orders transition"
+        )
+        data["items"] = items
+        data["n_ok"] = len([i for i in items if i["ok"]])
+        data["n_failed"] = len(items) - data["n_ok"]
+        self.write_json(data)
+
+
+class OrdersBulkApiV1(OrderApiV1Mixin, RequestHandler):
+    """Create, edit or change status of several orders in one API call.
+    Each operation is validated as for the single-order API calls.
+    The orders are saved using one bulk request to the database.
+    Several operations for the same order result in one save of it.
+    """
+
+    def post(self):
+        try:
+            self.check_login()
+        except ValueError as error:
+            raise tornado.web.HTTPError(403, reason=str(error))
+        try:
+            operations = self.get_json_body()["operations"]
+            if not isinstance(operations, list):
+                raise ValueError("'operations' is not a list")
+            if len(operations) > constants.BULK_LIMIT:
+                raise ValueError(f"more than {constants.BULK_LIMIT} operations")
+        except (KeyError, TypeError, ValueError) as error:
+            raise tornado.web.HTTPError(400, reason=f"invalid data: {error}")
+        savers = dict()  # Key: order IUID.
+        iuids = dict()  # Key: order identifier or IUID as given.
+        failed = set()  # IUIDs of orders for which some operation failed.
+        created = []  # IUIDs of new orders.
+        items = []
+        for index, operation in enumerate(operations):
+            item = dict(index=index)
+            items.append(item)
+            try:
+                if not isinstance(operation, dict):
+                    raise ValueError("operation is not a dictionary")
+                item["op"] = operation.get("op")
+                if item["op"] == "create":
+                    order_saver = self.create_order(operation)
+                    item["iuid"] = order_saver.doc["_id"]
+                    savers[item["iuid"]] = order_saver
+                    created.append(item["iuid"])
+                    continue
+                identifier = operation.get("order")
+                if not identifier:
+                    raise ValueError("no order identifier or IUID given")
+                try:
+                    item["iuid"] = iuids[identifier]
+                except KeyError:
+                    order = self.get_order(str(identifier))
+                    item["iuid"] = iuids[identifier] = order["_id"]
+                    if order["_id"] not in savers:
+                        savers[order["_id"]] = OrderSaver(doc=order, handler=self)
+                if item["iuid"] in failed:
+                    continue
+                order_saver = savers[item["iuid"]]
+                self.check_editable(order_saver.doc)
+                if item["op"] == "update":
+                    self.update_order(order_saver, operation)
+                elif item["op"] == "transition":
+                    order_saver.set_status(operation.get("status"))
+                else:
+                    raise ValueError("invalid op; must be create, update or transition")
+            except (ValueError, TypeError, KeyError) as error:
+                item["error"] = str(error)
+            except tornado.web.HTTPError as error:
+                item["error"] = error.reason or error.log_message or str(error)
+            # A failed operation may have partially modified the order; skip it.
+            if "error" in item and item.get("iuid") in savers:
+                failed.add(item["iuid"])
+        for iuid in failed:
+            savers.pop(iuid, None)
+        # Allocate identifiers only for new orders to be saved; avoids gaps.
+        for iuid in created:
+            if iuid in savers:
+                savers[iuid].set_identifier()
+        errors = dict(
+            zip(savers.keys(), saver.save_bulk(self.db, list(savers.values())))
+        )
+        for item in items:
+            if "error" in item:
+                item["ok"] = False
+            elif item["iuid"] in failed:
+                item["ok"] = False
+                item["error"] = "other operation on the same order failed"
+            elif errors[item["iuid"]]:
+                item["ok"] = False
+                item["error"] = errors[item["iuid"]]
+            else:
+                item["ok"] = True
+                order = savers[item["iuid"]].doc
+                item["identifier"] = order.get("identifier")
+                item["links"] = dict(
+                    api=dict(href=self.order_reverse_url(order, api=True)),
+                    display=dict(href=self.order_reverse_url(order)),
+                )
+        data = utils.get_json(
+            self.absolute_reverse_url("orders_bulk_api"), "orders bulk"
+        )
+        data["items"] = items
+        data["n_ok"] = len([i for i in items if i["ok"]])
+        data["n_failed"] = len(items) - data["n_ok"]
+        self.write_json(data)
+
+    def create_order(self, operation):
+        "Return the saver for a new order as specified by the operation."
+        self.check_creation_enabled()
+        iuid = operation.get("form")
+        if not iuid:
+            raise ValueError("No form IUID given.")
+        form = self.get_form(iuid)
+        if form["status"] not in (constants.ENABLED, constants.TESTING):
+            raise ValueError("form is not available for creation")
+        order_saver = OrderSaver(handler=self)
+        order_saver.create(form, title=operation.get("title"), identifier=False)
+        order_saver.autopopulate()
+        if operation.get("fields"):
+            order_saver.update_fields(data=operation["fields"])
+        else:
+            order_saver.check_fields_validity()
+        return order_saver
+
+    def update_order(self, saver, operation):
+        "Update the order as specified by the operation; same as for 'OrderApiV1'."
+        try:
+            saver["title"] = operation["title"]
+        except KeyError:
+            pass
+        try:
+            tags = operation["tags"]
+        except KeyError:
+            pass
+        else:
+            if isinstance(tags, str):
+                tags = [tags]
+            saver.set_tags(tags)
+        try:
+            saver.set_external(operation["links"]["external"])
+        except KeyError:
+            pass
+        try:
+            saver.update_fields(data=operation["fields"])
+        except KeyError:
+            pass
+        if self.am_admin():
+            try:
+                saver.set_history(operation["history"])
+            except KeyError:
+                pass
 
 
 class OrderFile(OrderMixin, RequestHandler):
@@ -1395,18 +1761,18 @@ class OrderFile(OrderMixin, RequestHandler):
             raise tornado.web.HTTPError(400)
         order = self.get_order(iuid)
         self.check_attachable(order)
-        fields = Fields(self.get_form(order["form"]))
+        fields = get_compiled_fields(self.get_form(order["form"]))
         with OrderSaver(doc=order, handler=self) as saver:
             for key in order["fields"]:
                 # Remove the field value if it is the filename.
                 # NOTE: Slightly dangerous: may delete a value that happens to
                 # be identical to the filename. Shouldn't be too commmon...
                 if order["fields"][key] == filename:
-                    order["fields"][key] = None
+                    saver["fields"][key] = None
                     if fields[key]["required"]:
-                        saver.doc["invalid"][key] = "missing value"
+                        saver["invalid"][key] = "missing value"
                     else:
-                        saver.doc["invalid"].pop(key, None)
+                        saver["invalid"].pop(key, None)
                     break
             saver.delete_filename = filename
             saver.changed["file_deleted"] = filename
@@ -1434,19 +1800,6 @@ class Orders(RequestHandler):
             all_count = 0
         else:
             all_count = r.value
-        # Account info lookups; dummies if not used.
-        if settings["ORDERS_LIST_OWNER_UNIVERSITY"]:
-            accounts_university = self.get_accounts_university()
-        else:
-            accounts_university = None
-        if settings["ORDERS_LIST_OWNER_DEPARTMENT"]:
-            accounts_department = self.get_accounts_department()
-        else:
-            accounts_department = None
-        if settings["ORDERS_LIST_OWNER_GENDER"]:
-            accounts_gender = self.get_accounts_gender()
-        else:
-            accounts_gender = None
         # Default ordering by the 'modified' column.
         if settings["DEFAULT_ORDER_COLUMN"] == "modified":
             order_column = (
@@ -1465,12 +1818,7 @@ class Orders(RequestHandler):
         else:
             order_column = 0
         self.set_filter()
-        forms = [
-            row.doc
-            for row in self.db.view(
-                "form", "modified", descending=True, include_docs=True
-            )
-        ]
+        forms = self.get_form_catalogue().get_all()
         self.render(
             "order/list.html",
             forms=forms,
@@ -1478,50 +1826,9 @@ class Orders(RequestHandler):
             filter=self.filter,
             orders=self.get_orders(),
             order_column=order_column,
-            accounts_university=accounts_university,
-            accounts_department=accounts_department,
-            accounts_gender=accounts_gender,
             all_count=all_count,
         )
 
-    def get_accounts_university(self):
-        "Get dictionary with email as key and university as value."
-        return dict(
-            [
-                (email, account.get("university"))
-                for email, account in self.get_all_accounts().items()
-            ]
-        )
-
-    def get_accounts_department(self):
-        "Get dictionary with email as key and department as value."
-        return dict(
-            [
-                (email, account.get("department"))
-                for email, account in self.get_all_accounts().items()
-            ]
-        )
-
-    def get_accounts_gender(self):
-        "Get dictionary with email as key and gender as value."
-        return dict(
-            [
-                (email, account.get("gender"))
-                for email, account in self.get_all_accounts().items()
-            ]
-        )
-
-    def get_all_accounts(self):
-        "Get all accounts docs; from cache if it exists, otherwise create it."
-        try:
-            return self.cache_all_accounts
-        except AttributeError:
-            self.logger.debug("Getting all accounts into request cache.")
-            self.cache_all_accounts = {}
-            for row in self.db.view("account", "email", include_docs=True):
-                self.cache_all_accounts[row.key] = row.doc
-            return self.cache_all_accounts
-
     def set_filter(self):
         "Set the filter settings dictionary."
         self.filter = dict()
@@ -1667,7 +1974,7 @@ class Orders(RequestHandler):
 class OrdersApiV1(OrderApiV1Mixin, OrderMixin, Orders):
     "Orders API; JSON output."
 
-    def get(self):
+    async def get(self):
         "JSON output."
         URL = self.absolute_reverse_url
         self.check_staff()
@@ -1677,20 +1984,108 @@ class OrdersApiV1(OrderApiV1Mixin, OrderMixin, Orders):
         result["links"] = dict(
             api=dict(href=URL("orders_api")), display=dict(href=URL("orders"))
         )
-        result["items"] = []
-        for order in self.get_orders():
-            data = self.get_order_json(order)
-            data["fields"] = dict()
-            for key in settings["ORDERS_LIST_FIELDS"]:
-                data["fields"][key] = order["fields"].get(key)
-            result["items"].append(data)
-            result["invalid"] = order["invalid"]
-        self.write(result)
+        orders = self.get_orders()
+        projection = self.get_projection()
+        if "reports" in self.get_includes() and (
+            projection is None or "reports" in projection
+        ):
+            reports_lookup = self.get_reports_lookup(orders)
+        else:
+            reports_lookup = dict()
+        await self.write_json_items(
+            result, "items", self.get_items(orders, reports_lookup, projection)
+        )
+
+    def get_items(self, orders, reports_lookup, projection):
+        "Generate the JSON data for the orders in the list."
+        identifiers = self.get_projection_fields(projection)
+        if identifiers is None:
+            identifiers = settings["ORDERS_LIST_FIELDS"]
+        for order in orders:
+            data = self.get_order_json(
+                order, reports=reports_lookup.get(order["_id"]), projection=projection
+            )
+            if projection is None or "fields" in projection:
+                data["fields"] = dict()
+                for key in identifiers:
+                    data["fields"][key] = order["fields"].get(key)
+            if projection is None or "invalid" in projection:
+                data["invalid"] = order["invalid"]
+            yield data
+
+
+class OrdersSyncApiV1(OrderApiV1Mixin, RequestHandler):
+    """Orders changed or deleted since the given cursor; JSON output.
+    Uses the CouchDB changes feed, so the cost depends on the number
+    of changes, not on the number of orders.
+    """
+
+    def get(self):
+        URL = self.absolute_reverse_url
+        try:
+            self.check_login()
+        except ValueError as error:
+            raise tornado.web.HTTPError(403, reason=str(error))
+        try:
+            since = self.decode_cursor(self.get_argument("cursor", None))
+            limit = int(self.get_argument("limit", constants.SYNC_LIMIT))
+            if limit <= 0:
+                raise ValueError("invalid limit")
+        except (ValueError, TypeError) as error:
+            raise tornado.web.HTTPError(400, reason=str(error))
+        limit = min(limit, constants.SYNC_LIMIT)
+        result = self.db.changes(
+            filter="order/orders", include_docs=True, since=since, limit=limit
+        )
+        changed = []
+        deleted = []
+        for change in result["results"]:
+            doc = change.get("doc")
+            if not doc or not self.allow_read(doc):
+                continue
+            if change.get("deleted"):
+                deleted.append(dict(iuid=doc["_id"], identifier=doc.get("identifier")))
+            else:
+                changed.append(doc)
+        reports_lookup = self.get_reports_lookup(changed)
+        projection = self.get_projection()
+        data = utils.get_json(URL("orders_sync_api"), "orders sync")
+        data["cursor"] = self.encode_cursor(result["last_seq"])
+        data["more"] = bool(result.get("pending"))
+        data["links"] = dict(
+            api=dict(href=URL("orders_sync_api", cursor=data["cursor"]))
+        )
+        data["deleted"] = deleted
+        data["changed"] = [
+            self.get_order_json(
+                order,
+                full=True,
+                reports=reports_lookup[order["_id"]],
+                projection=projection,
+            )
+            for order in changed
+        ]
+        self.write_json(data)
+
+    def decode_cursor(self, cursor):
+        "Get the database update sequence from the opaque cursor."
+        if not cursor:
+            return 0
+        try:
+            return base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8")
+        except (binascii.Error, UnicodeError):
+            raise ValueError("invalid cursor")
+
+    def encode_cursor(self, seq):
+        "Encode the database update sequence as an opaque cursor."
+        return base64.urlsafe_b64encode(str(seq).encode("utf-8")).decode("ascii")
 
 
 class OrdersCsv(Orders):
     "Orders list as CSV file."
 
+    export = True
+
     @tornado.web.authenticated
     def get(self):
         # Ordinary users are not allowed to see the overall orders list.
@@ -1715,21 +2110,20 @@ class OrdersCsv(Orders):
         # Account info lookups for optional columns.
         if settings["ORDERS_LIST_OWNER_UNIVERSITY"]:
             row.append("Owner university")
-            accounts_university = self.get_accounts_university()
         if settings["ORDERS_LIST_OWNER_DEPARTMENT"]:
             row.append("Owner department")
-            accounts_department = self.get_accounts_department()
         if settings["ORDERS_LIST_OWNER_GENDER"]:
             row.append("Owner gender")
-            accounts_gender = self.get_accounts_gender()
         row.append("Tags")
         row.extend(settings["ORDERS_LIST_FIELDS"])
         row.append("Status")
         row.extend([s.capitalize() for s in settings["ORDERS_LIST_STATUSES"]])
         row.append("Modified")
         writer.writerow(row)
+        account_directory = self.get_account_directory()
         for order in self.get_orders():
             form = self.lookup_form(order["form"])
+            owner = account_directory.get(order["owner"])
             row = [
                 order.get("identifier") or "",
                 order["title"] or "[no title]",
@@ -1739,15 +2133,15 @@ class OrdersCsv(Orders):
                 order["form"],
                 self.absolute_reverse_url("form", order["form"]),
                 order["owner"],
-                self.lookup_account_name(order["owner"]),
+                account_directory.get_name(order["owner"]),
                 self.absolute_reverse_url("account", order["owner"]),
             ]
             if settings["ORDERS_LIST_OWNER_UNIVERSITY"]:
-                row.append(accounts_university[order["owner"]])
+                row.append(owner.get("university"))
             if settings["ORDERS_LIST_OWNER_DEPARTMENT"]:
-                row.append(accounts_department[order["owner"]])
+                row.append(owner.get("department"))
             if settings["ORDERS_LIST_OWNER_GENDER"]:
-                row.append(accounts_gender[order["owner"]])
+                row.append(owner.get("gender"))
             row.append(", ".join(order.get("tags", [])))
             for f in settings["ORDERS_LIST_FIELDS"]:
                 value = order["fields"].get(f)
@@ -0,0 +1,141 @@
+"""Per-request profile of where the time goes: CouchDB calls, template
+rendering and email server (SMTP) calls.
+"""
+
+import contextlib
+import contextvars
+import time
+
+import orderportal.metrics
+
+# Number of slowest view queries recorded for a request.
+SLOWEST_VIEWS = 5
+
+# The profile being recorded in the current request or task, if any.
+current = contextvars.ContextVar("profile", default=None)
+
+
+class Profile:
+    "Counts and total times of the calls made during a request."
+
+    # Categories, and their names in the 'Server-Timing' header.
+    CATEGORIES = dict(
+        view="db-view", get="db-get", put="db-put", render="tpl", smtp="smtp"
+    )
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.counts = dict([(c, 0) for c in self.CATEGORIES])
+        self.times = dict([(c, 0.0) for c in self.CATEGORIES])
+        self.views = []  # Tuples (seconds, design/view); only the slowest.
+
+    def add(self, category, seconds, view=None):
+        "Record a call of the category and the time it took."
+        self.counts[category] += 1
+        self.times[category] += seconds
+        if category in ("view", "get", "put"):
+            orderportal.metrics.registry.observe_db(category, view, seconds)
+        if view is not None:
+            self.views.append((seconds, view))
+            self.views.sort(reverse=True)
+            del self.views[SLOWEST_VIEWS:]
+
+    @contextlib.contextmanager
+    def timer(self, category, view=None):
+        "Context manager recording the time of the enclosed call."
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(category, time.perf_counter() - start, view=view)
+
+    def activate(self):
+        "Make this the current profile. Return the token to reset it."
+        return current.set(self)
+
+    @property
+    def elapsed(self):
+        "Seconds since the start of the profile."
+        return time.perf_counter() - self.start
+
+    def get_server_timing(self):
+        "Return the value for the 'Server-Timing' header."
+        items = []
+        for category, name in self.CATEGORIES.items():
+            if self.counts[category]:
+                items.append(
+                    f"{name};dur={1000*self.times[category]:.1f};"
+                    f'desc="{self.counts[category]} calls"'
+                )
+        items.append(f"total;dur={1000*self.elapsed:.1f}")
+        return ", ".join(items)
+
+    def get_data(self):
+        "Return a dictionary of the counts and times (milliseconds)."
+        result = dict(total_ms=round(1000 * self.elapsed, 1))
+        for category in self.CATEGORIES:
+            result[f"{category}_n"] = self.counts[category]
+            result[f"{category}_ms"] = round(1000 * self.times[category], 1)
+        return result
+
+    def get_slowest_views(self):
+        "Return a list of the slowest view queries, with times in milliseconds."
+        return [dict(view=v, ms=round(1000 * s, 1)) for s, v in self.views]
+
+
+@contextlib.contextmanager
+def timer(category):
+    "Record the time of the enclosed call in the current profile, if any."
+    profile = current.get()
+    if profile is None:
+        yield
+    else:
+        with profile.timer(category):
+            yield
+
+
+class ProfiledDatabase:
+    """Wrapper for the CouchDB database handle, recording the view, get and
+    put calls in the profile. All other attributes are those of the database.
+    """
+
+    def __init__(self, db, profile):
+        self._db = db
+        self._profile = profile
+
+    def __getattr__(self, name):
+        return getattr(self._db, name)
+
+    def __getitem__(self, id):
+        with self._profile.timer("get"):
+            return self._db[id]
+
+    def __contains__(self, id):
+        with self._profile.timer("get"):
+            return id in self._db
+
+    def __iter__(self):
+        return iter(self._db)
+
+    def __len__(self):
+        return len(self._db)
+
+    def view(self, designname, viewname, *args, **kwargs):
+        with self._profile.timer("view", view=f"{designname}/{viewname}"):
+            return self._db.view(designname, viewname, *args, **kwargs)
+
+    def get(self, id, *args, **kwargs):
+        with self._profile.timer("get"):
+            return self._db.get(id, *args, **kwargs)
+
+    def get_bulk(self, ids):
+        with self._profile.timer("get"):
+            return self._db.get_bulk(ids)
+
+    def put(self, doc):
+        with self._profile.timer("put"):
+            return self._db.put(doc)
+
+    def update(self, docs, *args, **kwargs):
+        with self._profile.timer("put"):
+            return self._db.update(docs, *args, **kwargs)
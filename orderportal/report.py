@@ -413,7 +413,9 @@ class ReportApiV1(ReportApiV1Mixin, RequestHandler):
                 )
         except ValueError as error:
             raise tornado.web.HTTPError(403, reason=str(error))
-        self.write(self.get_report_json(report))
+        if self.check_not_modified([report, order]):
+            return
+        self.write_json(self.get_report_json(report, order))
 
     def post(self, iuid):
         try:
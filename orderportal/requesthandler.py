@@ -1,6 +1,8 @@
 "RequestHandler subclass for all pages."
 
 import base64
+import datetime
+import hashlib
 import json
 import logging
 import traceback
@@ -9,20 +11,92 @@ import urllib.error
 import urllib.parse
 
 import couchdb2
+import tornado.escape
+import tornado.ioloop
 import tornado.web
 
 from orderportal import constants, settings
 from orderportal import utils
 import orderportal.database
+import orderportal.directory
+import orderportal.metrics
+import orderportal.profiling
+
+
+# Process-wide cache of absolute URL templates; key: (handler name, number of args).
+_url_templates = dict()
 
 
 class RequestHandler(tornado.web.RequestHandler):
     "Base request handler."
 
+    # Is the response an export of data; CSV, XLSX or ZIP? For metrics.
+    export = False
+
     def prepare(self):
-        "Get the database connection and logger."
-        self.db = orderportal.database.get_db()
+        "Get the database connection, wrapped for the request profile, and logger."
+        self.profile = orderportal.profiling.Profile()
+        self.profile.activate()
+        self.db = orderportal.profiling.ProfiledDatabase(
+            orderportal.database.get_db(), self.profile
+        )
         self.logger = logging.getLogger("orderportal")
+        if self.export:
+            orderportal.metrics.registry.export_started(self)
+            self._exporting = True
+
+    def render_string(self, template_name, **kwargs):
+        "Record the time of rendering the outermost template in the profile."
+        profile = getattr(self, "profile", None)
+        if profile is None or getattr(self, "_rendering", False):
+            return super().render_string(template_name, **kwargs)
+        self._rendering = True
+        try:
+            with profile.timer("render"):
+                return super().render_string(template_name, **kwargs)
+        finally:
+            self._rendering = False
+
+    def finish(self, chunk=None):
+        "Add the 'Server-Timing' header, unless the headers have been sent."
+        profile = getattr(self, "profile", None)
+        if profile is not None and not self._headers_written:
+            self.set_header("Server-Timing", profile.get_server_timing())
+        return super().finish(chunk)
+
+    def on_finish(self):
+        """Log the request profile. A slow request is logged as a warning,
+        with its slowest view queries.
+        """
+        self.end_export()
+        profile = getattr(self, "profile", None)
+        if profile is None:
+            return
+        orderportal.metrics.registry.observe_request(self, profile.elapsed)
+        data = dict(
+            method=self.request.method,
+            path=self.request.path,
+            status=self.get_status(),
+            handler=type(self).__name__,
+        )
+        data.update(profile.get_data())
+        threshold = settings["SLOW_REQUEST_MS"]
+        if threshold and data["total_ms"] >= threshold:
+            data["slowest_views"] = profile.get_slowest_views()
+            self.logger.warning(f"Slow request {utils.json_dumps(data).decode()}")
+        else:
+            self.logger.debug(f"Request {utils.json_dumps(data).decode()}")
+
+    def on_connection_close(self):
+        "The client closed the connection; the export, if any, has ended."
+        self.end_export()
+        super().on_connection_close()
+
+    def end_export(self):
+        "Record the end of the export, if any, in the metrics; only once."
+        if getattr(self, "_exporting", False):
+            orderportal.metrics.registry.export_finished(self)
+            self._exporting = False
 
     def get_template_namespace(self):
         "Set the items accessible within the template."
@@ -32,6 +106,7 @@ class RequestHandler(tornado.web.RequestHandler):
         result["terminology"] = utils.terminology
         result["absolute_reverse_url"] = self.absolute_reverse_url
         result["order_reverse_url"] = self.order_reverse_url
+        result["site_url"] = self.site_url
         result["am_staff"] = self.am_staff()
         result["am_admin"] = self.am_admin()
         result["error"] = urllib.parse.unquote_plus(self.get_cookie("error", ""))
@@ -81,13 +156,41 @@ class RequestHandler(tornado.web.RequestHandler):
         self.redirect(self.absolute_reverse_url(name, *args, **query), status=303)
 
     def absolute_reverse_url(self, name, *args, **query):
-        "Get the absolute URL given the handler name, arguments and query."
+        """Get the absolute URL given the handler name, arguments and query.
+        A cached template for the URL is used when there is no query.
+        """
         if name is None:
             path = settings["BASE_URL_PATH_PREFIX"] or ""
-        else:
+        elif query:
             path = self.reverse_url(name, *args, **query).lstrip("/")
+        else:
+            return self.get_url_template(name, len(args)).format(
+                *[
+                    tornado.escape.url_escape(
+                        a if isinstance(a, (str, bytes)) else str(a), plus=False
+                    )
+                    for a in args
+                ]
+            ).rstrip("?")
         return settings["BASE_URL"] + path
 
+    def get_url_template(self, name, n_args):
+        "Get the absolute URL template for the handler name and number of args."
+        key = (name, n_args)
+        try:
+            return _url_templates[key]
+        except KeyError:
+            placeholders = [f"URLTEMPLATEARG{i}X" for i in range(n_args)]
+            path = super().reverse_url(name, *placeholders)
+            if settings["BASE_URL_PATH_PREFIX"]:
+                path = f"/{settings['BASE_URL_PATH_PREFIX']}{path}"
+            template = settings["BASE_URL"] + path.lstrip("/")
+            template = template.replace("{", "{{").replace("}", "}}")
+            for i, placeholder in enumerate(placeholders):
+                template = template.replace(placeholder, "{%s}" % i)
+            _url_templates[key] = template
+            return template
+
     def reverse_url(self, name, *args, **query):
         "Allow adding query arguments to the URL."
         url = super().reverse_url(name, *args)
@@ -109,6 +212,13 @@ class RequestHandler(tornado.web.RequestHandler):
             url = urllib.parse.urlunparse(parts)
         return url
 
+    def site_url(self, name):
+        "Returns the URL for a site file, including its version if it exists."
+        data = settings.get(f"SITE_{name.upper()}")
+        if data:
+            return self.reverse_url("site", name, v=data["digest"])
+        return self.reverse_url("site", name)
+
     def order_reverse_url(self, order, api=False, **query):
         "URL for order; use identifier variant if available. Always absolute."
         URL = self.absolute_reverse_url
@@ -295,16 +405,17 @@ class RequestHandler(tornado.web.RequestHandler):
         "Get the form given by its IUID."
         return self.get_entity(iuid, doctype=constants.FORM)
 
-    def lookup_form(self, iuid):
-        """Lookup the form by its IUID. When called the first time,
-        set up a cached dictionary 'lookup_forms' containing all forms.
-        """
+    def get_form_catalogue(self):
+        "Return the process-wide form catalogue, brought up to date once."
         try:
-            return self.lookup_forms.get(iuid)
+            return self._form_catalogue
         except AttributeError:
-            view = self.db.view("form", "modified", descending=True, include_docs=True)
-            self.lookup_forms = dict([(row.id, row.doc) for row in view])
-            return self.lookup_forms.get(iuid)
+            self._form_catalogue = orderportal.directory.get_catalogue(self.db)
+            return self._form_catalogue
+
+    def lookup_form(self, iuid):
+        "Lookup the form by its IUID in the form catalogue. Do not modify it."
+        return self.get_form_catalogue().get(iuid)
 
     def get_report(self, iuid):
         "Get the report for the IUID."
@@ -380,33 +491,25 @@ class RequestHandler(tornado.web.RequestHandler):
             return False
         return self.current_user["email"] in self.get_account_colleagues(email)
 
-    def lookup_account_name(self, email):
-        """Lookup the name "last, first" of the person for the account.
-        Sets up a cached dictionary 'lookup_accounts_names' when called the first time.
-        """
+    def get_account_directory(self):
+        "Return the process-wide account directory, brought up to date once."
         try:
-            return self.lookup_accounts_names.get(email) or email
+            return self._account_directory
         except AttributeError:
-            self.lookup_accounts_names = {}
-            for row in self.db.view("account", "email"):
-                self.lookup_accounts_names[row.key] = ", ".join(reversed(row.value))
-            return self.lookup_accounts_names.get(email) or email
+            self._account_directory = orderportal.directory.get_directory(self.db)
+            return self._account_directory
+
+    def lookup_account_name(self, email):
+        'Lookup the name "last, first" of the person for the account.'
+        return self.get_account_directory().get_name(email)
 
     def get_group(self, iuid):
         "Return the group for the IUID."
         return self.get_entity(iuid, doctype=constants.GROUP)
 
     def get_logs(self, iuid):
-        "Return the log documents for the given entity iuid."
-        view = self.db.view(
-            "log",
-            "entity",
-            include_docs=True,
-            startkey=[iuid, constants.CEILING],
-            endkey=[iuid],
-            descending=True,
-        )
-        logs = [row.doc for row in view]
+        "Return the log documents for the given entity iuid, including archived."
+        logs = orderportal.database.get_logs(self.db, iuid)
         # Ref to entity in DB is not needed in each log entry.
         for log in logs:
             log["iuid"] = log.pop("_id")
@@ -415,9 +518,40 @@ class RequestHandler(tornado.web.RequestHandler):
             log.pop("entity")
         return logs
 
-    def delete_logs(self, iuid):
-        "Delete the log documents for the given entity iuid."
-        orderportal.database.delete_logs(self.db, iuid)
+    def delete_logs(self, iuid, batch_size=500):
+        """Delete the log documents for the given entity iuid.
+        If there are more than one batch of them, do it as a background job
+        using a separate database connection, so as not to delay the response.
+        """
+        view = self.db.view(
+            "log",
+            "entity",
+            startkey=[iuid],
+            endkey=[iuid, constants.CEILING],
+            limit=batch_size + 1,
+        )
+        if len(view) <= batch_size:
+            orderportal.database.delete_logs(self.db, iuid, batch_size=batch_size)
+            return
+        future = tornado.ioloop.IOLoop.current().run_in_executor(
+            None, self.delete_logs_background, iuid, batch_size
+        )
+        future.add_done_callback(self.delete_logs_done)
+
+    @staticmethod
+    def delete_logs_background(iuid, batch_size):
+        "Delete the log documents in a background thread; own database connection."
+        db = orderportal.database.get_db()
+        return orderportal.database.delete_logs(db, iuid, batch_size=batch_size)
+
+    @staticmethod
+    def delete_logs_done(future):
+        "Log the outcome of the background deletion of log documents."
+        logger = logging.getLogger("orderportal")
+        try:
+            logger.info(f"deleted {future.result()} log documents in background")
+        except Exception as error:
+            logger.error(f"background deletion of log documents failed: {error}")
 
 
 class ApiV1Mixin:
@@ -439,3 +573,64 @@ class ApiV1Mixin:
     def check_xsrf_cookie(self):
         "Do not check for XSRF cookie when API."
         pass
+
+    def check_not_modified(self, docs, *dependencies):
+        """Set the ETag header computed from the revisions of the documents
+        and any other dependencies, such as counts, and the Last-Modified
+        header from the most recent modification of the documents.
+        The ETag also depends on the current user and the query.
+        Return True if the client has the current version; the response
+        status has then been set to 304 Not Modified.
+        """
+        parts = [doc["_rev"] for doc in docs]
+        parts.extend([str(d) for d in dependencies])
+        try:
+            parts.append(self.current_user["email"])
+        except (TypeError, KeyError):
+            pass
+        parts.append(self.request.query)
+        digest = hashlib.sha1("|".join(parts).encode("utf-8")).hexdigest()
+        self.set_header("ETag", f'"{digest}"')
+        modified = max([doc.get("modified") or "" for doc in docs])
+        if modified:
+            modified = datetime.datetime.fromisoformat(modified[:19]).replace(
+                tzinfo=datetime.timezone.utc
+            )
+            self.set_header("Last-Modified", modified)
+        if self.check_etag_header():
+            self.set_status(304)
+            return True
+        return False
+
+    def write_json(self, data):
+        "Write the data as JSON; encoded in one pass."
+        self.set_header("Content-Type", constants.JSON_MIMETYPE)
+        self.write(utils.json_dumps(data))
+
+    async def write_json_items(self, data, key, items, batch_size=100):
+        """Write the data as JSON, with the items as a list under the key.
+        The items, which may be given by a generator, are encoded one
+        by one, and output is flushed to the client for each batch.
+        An error after the first flush aborts the connection, so that
+        the client gets an incomplete response, not a truncated document.
+        """
+        self.set_header("Content-Type", constants.JSON_MIMETYPE)
+        head = utils.json_dumps(data)[:-1]  # Remove the closing brace.
+        if data:
+            head += b","
+        self.write(head + utils.json_dumps(key) + b":[")
+        try:
+            for count, item in enumerate(items):
+                if count:
+                    self.write(b",")
+                self.write(utils.json_dumps(item))
+                if count % batch_size == batch_size - 1:
+                    await self.flush()
+        except Exception:
+            if not self._headers_written:
+                raise
+            # Too late for an error response; abort the transfer instead.
+            self.logger.exception("Error while writing JSON items")
+            self.request.connection.close()
+            return
+        self.write(b"]}")
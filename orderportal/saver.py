@@ -1,17 +1,33 @@
 "Context handler for saving an entity as a CouchDB document. "
 
+import json
+import random
+import time
+
 import couchdb2
 import tornado.web
 
 from orderportal import constants
 from orderportal import utils
 
+# Marker for a key not present in a document.
+MISSING = object()
+
 
 class Saver:
     "Context manager saving the data for the document."
 
     doctype = None
 
+    # Number of times to attempt merging and re-saving on a revision conflict.
+    conflict_retries = 3
+    # Initial delay (seconds) before re-saving; doubled for each attempt,
+    # up to the maximum. Kept short, since it blocks the IOLoop.
+    conflict_delay = 0.01
+    conflict_delay_max = 0.1
+    # Is a key changed to the same value in the latest revision not a conflict?
+    merge_identical = False
+
     def __init__(self, doc=None, handler=None, db=None):
         assert self.doctype
         if handler is not None:
@@ -26,7 +42,14 @@ class Saver:
         self.changed = dict()
         if "_id" in self.doc:
             assert self.doctype == self.doc[constants.DOCTYPE]
+            # Snapshot required for merging in case of revision conflict.
+            # Stored encoded as JSON; cheaper than a deep copy.
+            if self.conflict_retries:
+                self.original = utils.json_dumps(self.doc)
+            else:
+                self.original = None
         else:
+            self.original = None
             self.doc[constants.DOCTYPE] = self.doctype
             self.doc["_id"] = utils.get_iuid()
             self.initialize()
@@ -39,13 +62,79 @@ class Saver:
         if type is not None:
             return False  # No exceptions handled here.
         self.finalize()
-        try:
-            self.db.put(self.doc)
-        except couchdb2.RevisionError:
-            raise IOError("document revision update conflict")
+        for attempt in range(self.conflict_retries + 1):
+            try:
+                self.db.put(self.doc)
+                break
+            except couchdb2.RevisionError:
+                if attempt >= self.conflict_retries:
+                    raise IOError("document revision update conflict")
+                delay = min(self.conflict_delay * 2**attempt, self.conflict_delay_max)
+                time.sleep(delay * random.uniform(0.5, 1.0))
+                self.merge_latest()
         self.post_process()
         self.log()
 
+    def merge_latest(self):
+        """Reapply the changes made in this saver onto the latest revision
+        of the document in the database. The changes are found by comparing
+        with the original values. For a dictionary value, such as the fields
+        of an order, the comparison is done item by item.
+        Raise IOError if the same key or item was changed in the latest revision.
+        """
+        if self.original is None:
+            raise IOError("document revision update conflict")
+        original = json.loads(self.original)
+        latest = self.db.get(self.doc["_id"])
+        if latest is None:
+            raise IOError("document was deleted while being updated")
+        patch = {}
+        for key in set(self.doc).union(original):
+            if key in ("_rev", "modified"):
+                continue
+            value = self.doc.get(key, MISSING)
+            old = original.get(key, MISSING)
+            if value == old:
+                continue
+            current = latest.get(key, MISSING)
+            if current == old or (self.merge_identical and current == value):
+                patch[key] = value
+            elif all([isinstance(v, dict) for v in (value, old, current)]):
+                patch[key] = self.merge_items(key, value, old, current)
+            else:
+                raise IOError(f"document revision update conflict for '{key}'")
+        self.original = utils.json_dumps(latest)
+        for key, value in patch.items():
+            if value is MISSING:
+                latest.pop(key, None)
+            else:
+                latest[key] = value
+        latest["modified"] = self.doc["modified"]
+        self.doc.clear()
+        self.doc.update(latest)
+
+    def merge_items(self, key, value, old, current):
+        """Return a new dictionary with the items changed from the old value
+        applied to the current value. Raise IOError if an item was changed
+        in both.
+        """
+        result = dict(current)
+        for item in set(value).union(old):
+            new = value.get(item, MISSING)
+            previous = old.get(item, MISSING)
+            if new == previous:
+                continue
+            latest = current.get(item, MISSING)
+            if latest != previous and not (self.merge_identical and latest == new):
+                raise IOError(
+                    f"document revision update conflict for '{key}' item '{item}'"
+                )
+            if new is MISSING:
+                result.pop(item, None)
+            else:
+                result[item] = new
+        return result
+
     def __setitem__(self, key, value):
         "Update the value for the key."
         try:
@@ -96,3 +185,38 @@ class Saver:
     def log(self):
         "Create a log entry for the change."
         utils.log(self.db, self.handler, self.doc, changed=self.changed)
+
+    def get_log_entry(self):
+        "Return the log entry document for the change, without saving it."
+        return utils.get_log_entry(self.handler, self.doc, changed=self.changed)
+
+
+def save_bulk(db, savers):
+    """Save the documents of the savers using one bulk request.
+    The savers must not have been used as context managers.
+    Post-processing is done for each saved document, and the log entries
+    are saved in one bulk request.
+    Return a list with None for each saved document, else an error message.
+    """
+    if not savers:
+        return []
+    for saver in savers:
+        saver.finalize()
+    results = db.update([saver.doc for saver in savers])
+    errors = []
+    entries = []
+    for saver, result in zip(savers, results):
+        if result[0]:
+            saver.doc["_rev"] = result[2]
+            saver.post_process()
+            entry = saver.get_log_entry()
+            if entry:
+                entries.append(entry)
+            errors.append(None)
+        elif result[2] == "conflict":
+            errors.append("document revision update conflict")
+        else:
+            errors.append(f"{result[2]}: {result[3]}")
+    if entries:
+        db.update(entries)
+    return errors
@@ -82,6 +82,35 @@ class AccountLink(tornado.web.UIModule):
         return f"""<a href="{url}">{exclaim}{title}</a>"""
 
 
+class OrderFragment(tornado.web.UIModule):
+    """Output the template rendered for the order, from the fragment cache
+    if the order, its form, the owner's name and affiliation, the role class
+    of the current user and the settings are unchanged since it was rendered.
+    Any other template arguments must be derived from these.
+    """
+
+    def render(self, path, order, form=None, **kwargs):
+        if form is None:
+            form = self.handler.lookup_form(order["form"])
+        owner = self.handler.get_account_directory().get(order["owner"])
+        key = (
+            path,
+            order["_id"],
+            order["_rev"],
+            form and form["_rev"],
+            self.handler.am_staff() and constants.STAFF or constants.USER,
+            settings.get("SETTINGS_VERSION"),
+            tuple(owner.values()),
+        )
+        html = utils.fragment_cache.lookup(key)
+        if html is None:
+            html = self.render_string(
+                path, order=order, form=form, owner=owner, **kwargs
+            )
+            utils.fragment_cache.store(key, html)
+        return html
+
+
 class GroupLink(tornado.web.UIModule):
     "HTML for link to a group."
 
@@ -141,6 +170,28 @@ class LogsLink(tornado.web.UIModule):
         return f"""<a href="{url}">{icon} Logs</a>"""
 
 
+class SortLink(tornado.web.UIModule):
+    """HTML for a column header link to sort a server-paginated list.
+    A click on the current sort column reverses the order.
+    """
+
+    def render(self, title, name, sort, filter, paging):
+        if paging["sort"] == sort:
+            order = paging["order"] == "asc" and "desc" or "asc"
+            if paging["order"] == "asc":
+                arrow = ' <span class="glyphicon glyphicon-triangle-top"></span>'
+            else:
+                arrow = ' <span class="glyphicon glyphicon-triangle-bottom"></span>'
+        else:
+            order = None
+            arrow = ""
+        query = dict(filter, sort=sort)
+        if order:
+            query["order"] = order
+        url = self.handler.reverse_url(name, **query)
+        return f"""<a href="{url}">{title}</a>{arrow}"""
+
+
 class CancelButton(tornado.web.UIModule):
     "Display a standard cancel button."
 
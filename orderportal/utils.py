@@ -1,9 +1,16 @@
 "Various utility functions."
 
+import collections
 import csv
 import datetime
+import gzip
+import hashlib
 import io
+import json
 import mimetypes
+import os
+import tempfile
+import threading
 import uuid
 
 import couchdb2
@@ -14,6 +21,16 @@ import xlsxwriter
 
 from orderportal import constants, settings
 
+try:
+    import orjson  # Optional; faster JSON encoding if installed.
+except ImportError:
+    orjson = None
+
+try:
+    import brotli  # Optional; brotli variants of static files if installed.
+except ImportError:
+    brotli = None
+
 
 def terminology(word):
     "Return the display term for the given word. Use itself by default."
@@ -100,6 +117,18 @@ def get_json(id, type):
     return result
 
 
+def json_dumps(data):
+    """Return the data encoded as JSON in UTF-8 bytes.
+    Use the 'orjson' module if installed, else the standard 'json' module.
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(data)
+        except TypeError:  # E.g. non-string keys; not handled by orjson.
+            pass
+    return json.dumps(data, ensure_ascii=False).encode("utf-8")
+
+
 def get_order_url(order):
     "Synthesize absolute order URL when 'handler' is not available."
     try:
@@ -114,6 +143,11 @@ def get_order_url(order):
 
 def log(db, handler, entity, changed=dict()):
     "Add a log entry for the change of the given entity."
+    db.put(get_log_entry(handler, entity, changed=changed))
+
+
+def get_log_entry(handler, entity, changed=dict()):
+    "Return a log entry document for the change of the given entity."
     entry = dict(
         _id=get_iuid(),
         entity=entity["_id"],
@@ -134,7 +168,7 @@ def log(db, handler, entity, changed=dict()):
         entry["account"] = handler.current_user["email"]
     except (AttributeError, TypeError, KeyError):
         pass
-    db.put(entry)
+    return entry
 
 
 def get_filename_extension(content_type):
@@ -175,13 +209,39 @@ class CsvWriter:
     def getvalue(self):
         return self.csvbuffer.getvalue()
 
+    def pop(self):
+        "Return the content written since the previous call, for streaming."
+        value = self.csvbuffer.getvalue()
+        self.csvbuffer.seek(0)
+        self.csvbuffer.truncate()
+        return value
+
+    def iter_chunks(self):
+        "Generate the remaining content, for streaming."
+        yield self.pop()
+
+    def cleanup(self):
+        "Nothing to clean up."
+        pass
+
 
 class XlsxWriter:
-    "Write rows serially to an XLSX file."
+    """Write rows serially to an XLSX file.
+    If 'constant_memory' is True, each row is flushed to a temporary file
+    when the next is written, so that memory use stays small for large files.
+    """
 
-    def __init__(self, worksheet="Main"):
-        self.xlsxbuffer = io.BytesIO()
-        self.workbook = xlsxwriter.Workbook(self.xlsxbuffer, {"in_memory": True})
+    def __init__(self, worksheet="Main", constant_memory=False):
+        if constant_memory:
+            fd, self.filepath = tempfile.mkstemp(suffix=".xlsx")
+            os.close(fd)
+            self.workbook = xlsxwriter.Workbook(
+                self.filepath, {"constant_memory": True}
+            )
+        else:
+            self.filepath = None
+            self.xlsxbuffer = io.BytesIO()
+            self.workbook = xlsxwriter.Workbook(self.xlsxbuffer, {"in_memory": True})
         self.ws = self.workbook.add_worksheet(worksheet)
         self.x = 0
 
@@ -199,16 +259,166 @@ class XlsxWriter:
 
     def getvalue(self):
         self.workbook.close()
+        if self.filepath:
+            try:
+                with open(self.filepath, "rb") as infile:
+                    return infile.read()
+            finally:
+                os.remove(self.filepath)
         self.xlsxbuffer.seek(0)
         return self.xlsxbuffer.getvalue()
 
+    def pop(self):
+        "Nothing can be output until the XLSX file is complete."
+        return b""
+
+    def iter_chunks(self, size=65536):
+        "Close the file and generate its content in chunks, for streaming."
+        if not self.filepath:
+            yield self.getvalue()
+            return
+        self.workbook.close()
+        try:
+            with open(self.filepath, "rb") as infile:
+                while True:
+                    chunk = infile.read(size)
+                    if not chunk:
+                        break
+                    yield chunk
+        finally:
+            self.cleanup()
+
+    def cleanup(self):
+        "Remove the temporary file, if any."
+        if self.filepath and os.path.exists(self.filepath):
+            os.remove(self.filepath)
+
+
+def get_digest(content):
+    "Return the digest of the content, for use as version and ETag."
+    return hashlib.sha256(content).hexdigest()[:32]
+
+
+def get_compressed_variants(content, content_type):
+    """Return a dictionary with key encoding and value the content compressed
+    by it, for each available encoding that makes the content smaller.
+    Empty if the content type is not worth compressing.
+    """
+    result = dict()
+    if not content_type:
+        return result
+    if content_type.split(";")[0].strip() not in constants.COMPRESSIBLE_MIMETYPES:
+        return result
+    if brotli is not None:
+        compressed = brotli.compress(content)
+        if len(compressed) < len(content):
+            result["br"] = compressed
+    compressed = gzip.compress(content, mtime=0)
+    if len(compressed) < len(content):
+        result["gzip"] = compressed
+    return result
+
+
+def get_accepted_encoding(request, variants):
+    """Return the encoding of the variant to send, according to the request
+    header 'Accept-Encoding'; brotli preferred over gzip. None if none.
+    """
+    if not variants:
+        return None
+    accepted = set()
+    for item in request.headers.get("Accept-Encoding", "").split(","):
+        parts = item.split(";")
+        encoding = parts[0].strip().lower()
+        try:
+            if float(parts[1].strip().split("=")[1]) <= 0.0:
+                continue
+        except IndexError:
+            pass
+        except ValueError:
+            continue
+        accepted.add(encoding)
+    for encoding in ("br", "gzip"):
+        if encoding in variants and (encoding in accepted or "*" in accepted):
+            return encoding
+    return None
+
 
 def markdown2html(text, safe=False):
-    "Process the text from Markdown to HTML."
-    text = text or ""
-    if not safe:
-        text = tornado.escape.xhtml_escape(text)
-    return marko.Markdown(renderer=HtmlRenderer).convert(text or "")
+    "Process the text from Markdown to HTML. The result is cached."
+    return markdown_cache.get(text or "", safe)
+
+
+class LruCache:
+    """Process-wide least-recently-used cache, with hit, miss and eviction
+    counts. The maximum number of entries is given by the named setting.
+    """
+
+    def __init__(self, size_key):
+        self.size_key = size_key
+        self.lock = threading.Lock()
+        self.cache = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def lookup(self, key):
+        "Return the value for the key; None if not in the cache."
+        with self.lock:
+            try:
+                value = self.cache[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            self.cache.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def store(self, key, value):
+        "Store the value for the key, evicting the least recently used if full."
+        with self.lock:
+            self.cache[key] = value
+            while len(self.cache) > settings[self.size_key]:
+                self.cache.popitem(last=False)
+                self.evictions += 1
+
+    def get_stats(self):
+        "Return a dictionary of the cache statistics."
+        with self.lock:
+            return dict(
+                size=len(self.cache),
+                hits=self.hits,
+                misses=self.misses,
+                evictions=self.evictions,
+            )
+
+    def clear(self):
+        "Remove all entries."
+        with self.lock:
+            self.cache.clear()
+
+
+class MarkdownCache(LruCache):
+    """Cache of Markdown texts rendered to HTML, keyed by the hash of
+    the text content and whether the text is safe, i.e. not escaped.
+    The parser is reused; it is not thread-safe, hence its own lock.
+    """
+
+    def __init__(self):
+        super().__init__("MARKDOWN_CACHE_SIZE")
+        self.parser = marko.Markdown(renderer=HtmlRenderer)
+        self.parser_lock = threading.Lock()
+
+    def get(self, text, safe):
+        "Return the HTML for the Markdown text, from the cache if present."
+        key = (hashlib.sha256(text.encode()).digest(), bool(safe))
+        html = self.lookup(key)
+        if html is None:
+            if not safe:
+                text = tornado.escape.xhtml_escape(text)
+            with self.parser_lock:
+                html = self.parser.convert(text)
+            self.store(key, html)
+        return html
 
 
 class HtmlRenderer(marko.html_renderer.HTMLRenderer):
@@ -250,6 +460,12 @@ class HtmlRenderer(marko.html_renderer.HTMLRenderer):
             return "".join([self.get_text_only(el) for el in element.children])
 
 
+markdown_cache = MarkdownCache()
+
+# Rendered template fragments; see 'uimodules.OrderFragment'.
+fragment_cache = LruCache("FRAGMENT_CACHE_SIZE")
+
+
 class SafeDict(dict):
     "Return error message, rather than raise exception, when entry is missing."
 
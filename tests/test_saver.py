@@ -0,0 +1,130 @@
+"""Test of the merge and retry on revision conflict in the saver.
+Uses an in-memory stand-in for the CouchDB database.
+"""
+
+import copy
+
+import couchdb2
+import pytest
+
+from orderportal import constants
+from orderportal import saver
+
+
+class Database:
+    "In-memory database with CouchDB-like revision checks."
+
+    def __init__(self):
+        self.docs = dict()
+        self.puts = 0
+
+    def put(self, doc):
+        self.puts += 1
+        current = self.docs.get(doc["_id"])
+        if current is not None and current["_rev"] != doc.get("_rev"):
+            raise couchdb2.RevisionError
+        doc["_rev"] = str(int(doc.get("_rev", "0")) + 1)
+        self.docs[doc["_id"]] = copy.deepcopy(doc)
+
+    def get(self, id):
+        return copy.deepcopy(self.docs.get(id))
+
+
+class AlwaysConflict(Database):
+    "Database where every put fails with a revision conflict."
+
+    def put(self, doc):
+        self.puts += 1
+        raise couchdb2.RevisionError
+
+
+class DocSaver(saver.Saver):
+    doctype = constants.ORDER
+    conflict_delay = 0.0
+
+    def log(self):
+        pass
+
+
+@pytest.fixture
+def db():
+    result = Database()
+    result.docs["a"] = {
+        "_id": "a",
+        "_rev": "1",
+        constants.DOCTYPE: constants.ORDER,
+        "title": "title",
+        "fields": {"x": 1, "y": 2},
+    }
+    return result
+
+
+def test_dict_item_merge(db):
+    "Concurrent changes of different items in a dictionary are merged."
+    first = db.get("a")
+    second = db.get("a")
+    with DocSaver(first, db=db) as saver:
+        saver["fields"]["x"] = 10
+    with DocSaver(second, db=db) as saver:
+        saver["fields"]["y"] = 20
+        saver["title"] = "new title"
+    doc = db.get("a")
+    assert doc["fields"] == {"x": 10, "y": 20}
+    assert doc["title"] == "new title"
+    assert doc["_rev"] == "3"
+
+
+def test_same_key_conflict(db):
+    "Concurrent changes of the same key are a conflict."
+    first = db.get("a")
+    second = db.get("a")
+    with DocSaver(first, db=db) as saver:
+        saver["title"] = "first"
+    with pytest.raises(IOError):
+        with DocSaver(second, db=db) as saver:
+            saver["title"] = "second"
+    assert db.get("a")["title"] == "first"
+
+
+def test_same_item_conflict(db):
+    "Concurrent changes of the same item in a dictionary are a conflict."
+    first = db.get("a")
+    second = db.get("a")
+    with DocSaver(first, db=db) as saver:
+        saver["fields"]["x"] = 10
+    with pytest.raises(IOError):
+        with DocSaver(second, db=db) as saver:
+            saver["fields"]["x"] = 11
+    assert db.get("a")["fields"]["x"] == 10
+
+
+def test_identical_change_conflict(db):
+    "Concurrent changes to the same value are a conflict, unless opted in."
+    first = db.get("a")
+    second = db.get("a")
+    with DocSaver(first, db=db) as saver:
+        saver["title"] = "same"
+    with pytest.raises(IOError):
+        with DocSaver(second, db=db) as saver:
+            saver["title"] = "same"
+
+    class IdenticalSaver(DocSaver):
+        merge_identical = True
+
+    first = db.get("a")
+    second = db.get("a")
+    with IdenticalSaver(first, db=db) as saver:
+        saver["title"] = "again"
+    with IdenticalSaver(second, db=db) as saver:
+        saver["title"] = "again"
+    assert db.get("a")["title"] == "again"
+
+
+def test_retry_exhaustion():
+    "Give up after the given number of retries."
+    db = AlwaysConflict()
+    db.docs["a"] = {"_id": "a", "_rev": "1", constants.DOCTYPE: constants.ORDER}
+    with pytest.raises(IOError):
+        with DocSaver(db.get("a"), db=db) as saver:
+            saver["title"] = "title"
+    assert db.puts == DocSaver.conflict_retries + 1